@@ -0,0 +1,72 @@
+"""
+Count the tasks running on *this* instance using the ECS agent introspection API
+
+Nothing here calls the ECS control plane - the task list comes from the local agent and the EC2 instance ID
+from the EC2 instance metadata service, so the cost is the same no matter how large the cluster is.
+
+Note that the agent only knows the task definition family of each task, so count_agent_tasks always counts by task
+definition family, even for tasks started by a service. Where ECS calls are allowed, the ARNs from get_agent_task_arns
+can be described instead (see task_snapshot.count_tasks) to count service tasks by service, as a cluster scan does.
+
+"""
+
+import json
+import logging
+import urllib2
+import capture
+from task_snapshot import add_task
+
+AGENT_URL = 'http://localhost:51678'
+EC2_METADATA_URL = 'http://169.254.169.254/latest'
+
+# Seconds to wait for the agent or metadata service
+REQUEST_TIMEOUT = 5
+
+# Metadata URL -> EC2 instance ID of this instance, which never changes, so it is only asked for once per process
+INSTANCE_IDS = {}
+
+
+def get_agent_tasks(agent_url=AGENT_URL):
+    '''Get the tasks the ECS agent on this instance knows about'''
+    response = capture.urlopen(agent_url + '/v1/tasks', timeout=REQUEST_TIMEOUT)
+    return json.loads(response.read().decode()).get('Tasks') or []
+
+
+def get_agent_task_arns(agent_url=AGENT_URL):
+    '''Get the ARNs of the tasks on this instance that are meant to be running'''
+    return [task['Arn'] for task in get_agent_tasks(agent_url) if task.get('DesiredStatus') == 'RUNNING']
+
+
+def count_agent_tasks(agent_url=AGENT_URL):
+    '''
+    Count the running tasks on this instance
+    :return: dict of family:{type, count}
+    '''
+    task_families = {}
+    for task in get_agent_tasks(agent_url):
+        # Same as list_tasks - count the tasks that are meant to be running
+        if task.get('DesiredStatus') != 'RUNNING':
+            continue
+        add_task(task_families, task['Family'], 'family')
+    return task_families
+
+
+def get_ec2_instance_id(metadata_url=EC2_METADATA_URL):
+    '''Get the EC2 instance ID of this instance, from INSTANCE_IDS or the EC2 instance metadata service'''
+    if metadata_url not in INSTANCE_IDS:
+        INSTANCE_IDS[metadata_url] = fetch_ec2_instance_id(metadata_url)
+    return INSTANCE_IDS[metadata_url]
+
+
+def fetch_ec2_instance_id(metadata_url=EC2_METADATA_URL):
+    '''Ask the metadata service for the EC2 instance ID, using an IMDSv2 token if the metadata service hands one out'''
+    headers = {}
+    try:
+        token_request = urllib2.Request(metadata_url + '/api/token',
+                                        headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        token_request.get_method = lambda: 'PUT'
+        headers['X-aws-ec2-metadata-token'] = capture.urlopen(token_request, timeout=REQUEST_TIMEOUT).read().decode()
+    except urllib2.URLError as e:
+        logging.debug('No IMDSv2 token, falling back to IMDSv1: %s' % e)
+    request = urllib2.Request(metadata_url + '/meta-data/instance-id', headers=headers)
+    return capture.urlopen(request, timeout=REQUEST_TIMEOUT).read().decode()
@@ -0,0 +1,106 @@
+"""
+Share boto3 sessions and clients between collector runs
+
+Creating a session and its clients means loading service models and opening new connection pools,
+so long-lived collectors create them once per region and reuse them on every cycle.
+
+Every client is rate limited (see rate_limiter), with one limiter per service and region and one retry
+budget for each cycle. A TargetClients hands out the same clients with a retry budget of their own, so when one
+collector daemon target uses up its retries, the other targets still have theirs. Every call is also recorded in the
+ClientCache's CycleStats.
+
+When capture.CAPTURE is set, the clients' calls are recorded to (or replayed from) a capture file - see capture.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import json
+import threading
+import boto3
+from botocore.config import Config
+import capture
+from cycle_stats import CycleStats
+from rate_limiter import DEFAULT_RATE, DEFAULT_RATES, DEFAULT_RETRY_BUDGET, AdaptiveRateLimiter, RateLimitedClient, RetryBudget
+
+METADATA_URL = 'http://localhost:51678/v1/metadata'
+
+
+def get_instance_metadata(metadata_url=METADATA_URL):
+    '''Get the cluster and region of *this* instance from the ECS agent metadata service'''
+    instance_metadata = json.loads(capture.urlopen(metadata_url).read().decode())
+    return {'cluster': instance_metadata['Cluster'],
+            'region': instance_metadata['ContainerInstanceArn'].split(':')[3],
+            'container_instance_arn': instance_metadata['ContainerInstanceArn']}
+
+
+class ClientCache(object):
+    '''
+    One boto3 session and one (rate limited) client per service for each region
+    :param profile: aws cli profile to use, if none provided, use role credentials
+    :param retry_budget: retries allowed per cycle, across all clients
+    :param stats: CycleStats to record the API calls in, if none provided, use a new one
+    '''
+
+    def __init__(self, profile=None, retry_budget=DEFAULT_RETRY_BUDGET, stats=None):
+        self.profile = profile
+        self.sessions = {}
+        self.clients = {}
+        self.limiters = {}
+        self.retry_budget = RetryBudget(retry_budget)
+        self.stats = stats or CycleStats()
+        # Re-entrant, as creating a client may create its session too
+        self.lock = threading.RLock()
+
+    def start_cycle(self):
+        ''' Give the next cycle a full retry budget '''
+        self.retry_budget.reset()
+
+    def session(self, region):
+        ''' Get the session for region, creating it if needed '''
+        with self.lock:
+            if region not in self.sessions:
+                self.sessions[region] = boto3.session.Session(profile_name=self.profile, region_name=region)
+            return self.sessions[region]
+
+    def client(self, service, region):
+        ''' Get the client for service in region, creating it if needed '''
+        def create_client():
+            # Retries are left to RateLimitedClient, so it sees (and adapts to) every throttled call
+            return self.session(region).client(service, config=Config(retries={'max_attempts': 0}))
+
+        with self.lock:
+            if (service, region) not in self.clients:
+                client = capture.CAPTURE.client(service, region, create_client) if capture.CAPTURE else create_client()
+                self.limiters[(service, region)] = AdaptiveRateLimiter(DEFAULT_RATES.get(service, DEFAULT_RATE))
+                self.clients[(service, region)] = RateLimitedClient(client, self.limiters[(service, region)], self.retry_budget,
+                                                                    self.stats)
+            return self.clients[(service, region)]
+
+
+class TargetClients(object):
+    '''
+    The clients of a ClientCache, drawing on a retry budget of their own - eg. for one target of the collector daemon
+    :param clients: ClientCache whose sessions, clients and rate limiters are shared
+    :param retry_budget: retries allowed per cycle, if none provided, the same as the ClientCache allows
+    '''
+
+    def __init__(self, clients, retry_budget=None):
+        self.shared = clients
+        self.retry_budget = RetryBudget(retry_budget or clients.retry_budget.retries)
+        self.stats = clients.stats
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def start_cycle(self):
+        ''' Give the next cycle a full retry budget '''
+        self.retry_budget.reset()
+
+    def client(self, service, region):
+        ''' Get the client for service in region, rate limited with the shared limiter but retried from this budget '''
+        with self.lock:
+            if (service, region) not in self.clients:
+                shared = self.shared.client(service, region)
+                self.clients[(service, region)] = RateLimitedClient(shared.client, shared.limiter, self.retry_budget,
+                                                                    self.stats)
+            return self.clients[(service, region)]
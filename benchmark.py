@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the collectors against a simulated ECS cluster, without any network access
+
+Builds a synthetic cluster (container instances, tasks and task families), serves it from fake ECS, CloudWatch and
+CloudFormation clients with optional latency and throttling, and runs push_task_count_metrics and/or
+push_scale_down_metric against it for a few cycles. For each cycle it reports the wall time, the API calls made by
+operation (and how many of them were throttled), the time spent in each phase and the memory the cycle needed - its
+peak resident set size less the resident set size it started with, so the simulated cluster itself is not counted.
+
+The fake clients go through the same rate limiting and retries as the real ones (see rate_limiter.py), and the
+caches are kept from one cycle to the next, as they are in the collector daemon - so the first cycle shows the cost
+of a cold start and the later ones the steady state. Use --churn to replace some of the tasks between cycles.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import argparse
+import collections
+import json
+import logging
+import random
+import resource
+import sys
+import time
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+import report_scale_down_metric
+import report_task_count_metrics
+from aws_clients import ClientCache
+from rate_limiter import DEFAULT_RATE, DEFAULT_RATES, AdaptiveRateLimiter, RateLimitedClient
+from instance_resolver import InstanceResolver
+from task_snapshot import TaskCache
+from reservation_window import ReservationWindow
+from threshold_provider import ThresholdProvider
+
+REGION = 'us-east-1'
+ACCOUNT = '123456789012'
+
+# Most items the fake list calls return per page, as ECS does
+MAX_RESULTS = 100
+
+
+class SimulatedCluster(object):
+    '''
+    A synthetic ECS cluster
+    :param name: cluster name
+    :param instances: number of container instances
+    :param tasks: number of running tasks, spread evenly over the instances
+    :param families: number of task definition families, spread evenly over the tasks
+    :param service_ratio: fraction of the tasks that were started by a service
+    :param seed: seed of the random choices, so runs are repeatable
+    '''
+
+    def __init__(self, name='benchmark', instances=100, tasks=1000, families=20, service_ratio=0.8, seed=0):
+        self.name = name
+        self.families = families
+        self.service_ratio = service_ratio
+        self.random = random.Random(seed)
+        self.task_count = 0
+        self.instances = {}
+        for index in range(instances):
+            arn = 'arn:aws:ecs:%s:%s:container-instance/%s/%032x' % (REGION, ACCOUNT, name, index)
+            self.instances[arn] = {'containerInstanceArn': arn,
+                                   'ec2InstanceId': 'i-%017x' % index,
+                                   'status': 'ACTIVE',
+                                   'registeredResources': [{'name': 'CPU', 'integerValue': 4096},
+                                                           {'name': 'MEMORY', 'integerValue': 16384}],
+                                   'remainingResources': [{'name': 'CPU', 'integerValue': 4096},
+                                                          {'name': 'MEMORY', 'integerValue': 16384}]}
+        self.instance_arns = sorted(self.instances)
+        self.tasks = {}
+        for index in range(tasks):
+            self.add_task(self.instance_arns[index % instances])
+        self.task_arns = sorted(self.tasks)
+
+    def add_task(self, instance_arn):
+        ''' Start a new task on the given container instance '''
+        family = 'family-%d' % self.random.randrange(self.families)
+        group = ('service:%s' if self.random.random() < self.service_ratio else 'family:%s') % family
+        arn = 'arn:aws:ecs:%s:%s:task/%s/%032x' % (REGION, ACCOUNT, self.name, self.task_count)
+        self.task_count += 1
+        self.tasks[arn] = {'taskArn': arn,
+                           'group': group,
+                           'containerInstanceArn': instance_arn,
+                           'taskDefinitionArn': 'arn:aws:ecs:%s:%s:task-definition/%s:1' % (REGION, ACCOUNT, family),
+                           'lastStatus': 'RUNNING',
+                           'desiredStatus': 'RUNNING',
+                           'cpu': '256',
+                           'memory': '512'}
+        self.reserve(instance_arn, -1)
+
+    def stop_task(self, arn):
+        ''' Stop the given task '''
+        self.reserve(self.tasks.pop(arn)['containerInstanceArn'], 1)
+
+    def reserve(self, instance_arn, sign):
+        ''' Give back (sign 1) or take (sign -1) the resources of one task on the given container instance '''
+        for resource_value in self.instances[instance_arn]['remainingResources']:
+            resource_value['integerValue'] += sign * (256 if resource_value['name'] == 'CPU' else 512)
+
+    def churn(self, ratio):
+        ''' Replace the given fraction of the tasks with new ones, on random container instances '''
+        for arn in self.random.sample(self.task_arns, int(len(self.task_arns) * ratio)):
+            self.stop_task(arn)
+            self.add_task(self.random.choice(self.instance_arns))
+        self.task_arns = sorted(self.tasks)
+
+    def reservation(self):
+        ''' Percentage of the cluster's CPU and memory reserved, as AWS/ECS CPUReservation and MemoryReservation '''
+        result = {}
+        for name, metric_name in (('CPU', 'CPUReservation'), ('MEMORY', 'MemoryReservation')):
+            registered = remaining = 0
+            for instance in self.instances.values():
+                registered += [r['integerValue'] for r in instance['registeredResources'] if r['name'] == name][0]
+                remaining += [r['integerValue'] for r in instance['remainingResources'] if r['name'] == name][0]
+            result[metric_name] = 100.0 * (registered - remaining) / registered if registered else 0.0
+        return result
+
+
+class ApiStats(object):
+    ''' Count the API calls made (and throttled) by operation '''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = collections.Counter()
+        self.throttled = collections.Counter()
+
+
+class FakeClient(object):
+    '''
+    Base of the fake clients - every call waits for latency seconds, and is throttled with the given probability
+    :param stats: ApiStats to count the calls in
+    :param latency: seconds each call takes
+    :param throttle_ratio: probability that a call is throttled
+    :param seed: seed of the throttling, so runs are repeatable
+    '''
+
+    def __init__(self, stats, latency=0.0, throttle_ratio=0.0, seed=0):
+        self.stats = stats
+        self.latency = latency
+        self.throttle_ratio = throttle_ratio
+        self.random = random.Random(seed)
+
+    def call(self, operation):
+        ''' Count (and possibly throttle) a call of operation '''
+        self.stats.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.throttle_ratio and self.random.random() < self.throttle_ratio:
+            self.stats.throttled[operation] += 1
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, operation)
+
+    @staticmethod
+    def page(items, next_token, max_results, result_key):
+        ''' One page of items from a list call, with the nextToken of the next page if there is one '''
+        start = int(next_token or 0)
+        end = start + min(max_results or MAX_RESULTS, MAX_RESULTS)
+        result = {result_key: items[start:end]}
+        if end < len(items):
+            result['nextToken'] = str(end)
+        return result
+
+
+class FakeEcs(FakeClient):
+    ''' The ECS calls the collectors make, served from a SimulatedCluster '''
+
+    def __init__(self, cluster, stats, **kwargs):
+        super(FakeEcs, self).__init__(stats, **kwargs)
+        self.cluster = cluster
+
+    def list_container_instances(self, cluster, status=None, nextToken=None, maxResults=None):
+        self.call('ListContainerInstances')
+        instance_arns = self.cluster.instance_arns
+        if status:
+            instance_arns = [arn for arn in instance_arns if self.cluster.instances[arn]['status'] == status]
+        return self.page(instance_arns, nextToken, maxResults, 'containerInstanceArns')
+
+    def describe_container_instances(self, cluster, containerInstances):
+        self.call('DescribeContainerInstances')
+        return {'containerInstances': [self.cluster.instances[arn] for arn in containerInstances
+                                       if arn in self.cluster.instances],
+                'failures': [{'arn': arn, 'reason': 'MISSING'} for arn in containerInstances
+                             if arn not in self.cluster.instances]}
+
+    def list_tasks(self, cluster, containerInstance=None, desiredStatus=None, nextToken=None, maxResults=None):
+        self.call('ListTasks')
+        task_arns = self.cluster.task_arns
+        if containerInstance:
+            task_arns = [arn for arn in task_arns if self.cluster.tasks[arn]['containerInstanceArn'] == containerInstance]
+        return self.page(task_arns, nextToken, maxResults, 'taskArns')
+
+    def describe_tasks(self, cluster, tasks):
+        self.call('DescribeTasks')
+        return {'tasks': [self.cluster.tasks[arn] for arn in tasks if arn in self.cluster.tasks],
+                'failures': [{'arn': arn, 'reason': 'MISSING'} for arn in tasks if arn not in self.cluster.tasks]}
+
+
+class FakeCloudWatch(FakeClient):
+    ''' PutMetricData, and the cluster's reservation metrics from GetMetricData '''
+
+    def __init__(self, cluster, stats, **kwargs):
+        super(FakeCloudWatch, self).__init__(stats, **kwargs)
+        self.cluster = cluster
+        self.metric_data = 0
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.call('PutMetricData')
+        self.metric_data += len(MetricData)
+        return {}
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None):
+        self.call('GetMetricData')
+        reservation = self.cluster.reservation()
+        minutes = []
+        minute = StartTime.replace(second=0, microsecond=0)
+        while minute < EndTime:
+            minutes.append(minute)
+            minute += timedelta(minutes=1)
+        return {'MetricDataResults': [{'Id': query['Id'],
+                                       'Timestamps': minutes,
+                                       'Values': [reservation[query['MetricStat']['Metric']['MetricName']]] * len(minutes),
+                                       'StatusCode': 'Complete'}
+                                      for query in MetricDataQueries]}
+
+
+class FakeCloudFormation(FakeClient):
+    ''' A stack holding the scale down thresholds '''
+
+    def describe_stacks(self, StackName):
+        self.call('DescribeStacks')
+        return {'Stacks': [{'StackName': StackName,
+                            'CreationTime': datetime(2020, 1, 1),
+                            'Parameters': [{'ParameterKey': 'ScaleDownCPU', 'ParameterValue': '40'},
+                                           {'ParameterKey': 'ScaleDownMemory', 'ParameterValue': '40'},
+                                           {'ParameterKey': 'ClusterMinSize', 'ParameterValue': '1'}]}]}
+
+
+class FakeClientCache(ClientCache):
+    '''
+    ClientCache handing out the fake clients, rate limited like the real ones
+    :param fakes: dict of service -> fake client
+    :param rate: calls per second every service starts at, if none provided, use the rate_limiter defaults
+    '''
+
+    def __init__(self, fakes, rate=None):
+        super(FakeClientCache, self).__init__()
+        self.fakes = fakes
+        self.rate = rate
+
+    def client(self, service, region):
+        with self.lock:
+            if (service, region) not in self.clients:
+                self.limiters[(service, region)] = AdaptiveRateLimiter(self.rate or DEFAULT_RATES.get(service, DEFAULT_RATE))
+                self.clients[(service, region)] = RateLimitedClient(self.fakes[service], self.limiters[(service, region)], self.retry_budget,
+                                                                    self.stats)
+            return self.clients[(service, region)]
+
+
+def peak_memory_kb():
+    ''' Peak resident set size of this process so far, in KB '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def proc_memory_kb(field):
+    ''' A memory field of /proc/self/status (eg. VmRSS, VmHWM), in KB '''
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise IOError('No %s in /proc/self/status' % field)
+
+
+def start_memory_measurement():
+    '''
+    Start measuring the memory a cycle needs - on Linux, reset the peak resident set size to the current one
+    :return: baseline to pass to cycle_memory_kb
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return 'VmHWM', proc_memory_kb('VmRSS')
+    except (IOError, OSError):
+        # The process-wide peak can only go up, so the cycle only shows if it sets a new peak
+        return None, peak_memory_kb()
+
+
+def cycle_memory_kb(baseline):
+    ''' KB of memory the cycle needed on top of what was resident when start_memory_measurement returned baseline '''
+    field, start_kb = baseline
+    peak_kb = proc_memory_kb(field) if field else peak_memory_kb()
+    return max(0, peak_kb - start_kb)
+
+
+def run_benchmark(cluster, collectors, cycles=3, latency=0.0, throttle_ratio=0.0, rate=None, churn=0.0,
+                  stack_name=None, live_reservation=False, seed=0):
+    '''
+    Run the collectors against the simulated cluster
+    :param cluster: SimulatedCluster to collect
+    :param collectors: names of the collectors to run - task-count and/or scale-down
+    :param cycles: number of cycles to run, keeping the caches between cycles
+    :param latency: seconds each API call takes
+    :param throttle_ratio: probability that an API call is throttled
+    :param rate: calls per second every service starts at, if none provided, use the rate_limiter defaults
+    :param churn: fraction of the tasks replaced between cycles
+    :param stack_name: read the scale down thresholds from this (fake) stack, rather than fixed thresholds
+    :param live_reservation: base the scale down decision on the container instances
+    :return: list of dicts, one per cycle and collector, with the wall time, API calls, phases and the memory it needed
+    '''
+    stats = ApiStats()
+    fake_args = {'latency': latency, 'throttle_ratio': throttle_ratio, 'seed': seed}
+    cloudwatch = FakeCloudWatch(cluster, stats, **fake_args)
+    clients = FakeClientCache({'ecs': FakeEcs(cluster, stats, **fake_args),
+                               'cloudwatch': cloudwatch,
+                               'cloudformation': FakeCloudFormation(stats, **fake_args)}, rate)
+
+    instance_resolver = InstanceResolver()
+    task_cache = TaskCache()
+    reservation_window = ReservationWindow()
+    threshold_provider = ThresholdProvider()
+
+    def collect_task_count():
+        report_task_count_metrics.push_task_count_metrics(region=REGION, cluster=cluster.name, clients=clients,
+                                                          instance_resolver=instance_resolver, task_cache=task_cache)
+
+    def collect_scale_down():
+        thresholds = {} if stack_name else {'cpu_threshold': 40, 'mem_threshold': 40, 'min_cluster_size': 1}
+        report_scale_down_metric.push_scale_down_metric(stack_name=stack_name, region=REGION, cluster_name=cluster.name,
+                                                        clients=clients, reservation_window=reservation_window,
+                                                        live_reservation=live_reservation,
+                                                        threshold_provider=threshold_provider, **thresholds)
+
+    functions = {'task-count': collect_task_count, 'scale-down': collect_scale_down}
+    results = []
+    for cycle in range(cycles):
+        if cycle and churn:
+            cluster.churn(churn)
+        for name in collectors:
+            clients.start_cycle()
+            clients.stats.start_cycle()
+            stats.reset()
+            cloudwatch.metric_data = 0
+            memory_baseline = start_memory_measurement()
+            start_time = time.time()
+            functions[name]()
+            cycle_stats = clients.stats.finish_cycle()
+            results.append({'cycle': cycle + 1,
+                            'collector': name,
+                            'wall_time': time.time() - start_time,
+                            'calls': dict(stats.calls),
+                            'throttled': dict(stats.throttled),
+                            'phases': cycle_stats['phases'],
+                            'metric_data': cloudwatch.metric_data,
+                            'cycle_memory_kb': cycle_memory_kb(memory_baseline)})
+    return results
+
+
+def print_results(results):
+    ''' Print the results of run_benchmark as a table '''
+    operations = sorted(set(operation for result in results for operation in result['calls']))
+    print('%-5s %-10s %9s %10s %12s  %s' % ('cycle', 'collector', 'wall (s)', 'metrics', 'memory (KB)',
+                                           '  '.join(operations)))
+    for result in results:
+        calls = ['%*s' % (len(operation), '%d/%d' % (result['calls'].get(operation, 0),
+                                                      result['throttled'].get(operation, 0)))
+                 for operation in operations]
+        print('%-5d %-10s %9.3f %10d %12d  %s' % (result['cycle'], result['collector'], result['wall_time'],
+                                                  result['metric_data'], result['cycle_memory_kb'], '  '.join(calls)))
+    print('(API calls are shown as calls/throttled, memory as the peak resident set size of the cycle above its start)')
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the collectors against a simulated ECS cluster')
+
+    parser.add_argument("--instances", help="Container instances in the cluster (default 1000)", dest='instances', type=int, default=1000)
+    parser.add_argument("--tasks", help="Tasks running in the cluster (default 50000)", dest='tasks', type=int, default=50000)
+    parser.add_argument("--families", help="Task definition families (default 50)", dest='families', type=int, default=50)
+    parser.add_argument("--collector", help="Collector to run (default both)", dest='collectors', choices=['task-count', 'scale-down'], action='append')
+    parser.add_argument("--cycles", help="Cycles to run, keeping the caches between cycles (default 3)", dest='cycles', type=int, default=3)
+    parser.add_argument("--churn", help="Fraction of the tasks replaced between cycles (default 0.01)", dest='churn', type=float, default=0.01)
+    parser.add_argument("--latency", help="Seconds each API call takes (default 0)", dest='latency', type=float, default=0.0)
+    parser.add_argument("--throttle", help="Fraction of the API calls that are throttled (default 0)", dest='throttle', type=float, default=0.0)
+    parser.add_argument("--rate", help="API calls per second every service starts at, if not provided, will use the rate limiter defaults", dest='rate', type=float, required=False)
+    parser.add_argument("--stack-name", help="Read the scale down thresholds from a (fake) stack", dest='stack_name', required=False)
+    parser.add_argument("--live-reservation", help="Base the scale down decision on the container instances", dest='live_reservation', action='store_true')
+    parser.add_argument("--seed", help="Seed of the simulated cluster and throttling (default 0)", dest='seed', type=int, default=0)
+    parser.add_argument("--output", help="Also write the results to this file as JSON", dest='output', required=False)
+    parser.add_argument("--verbose", help="Turn on DEBUG logging", action='store_true', required=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING, format='%(levelname)8s: %(message)s')
+
+    start_time = time.time()
+    simulated_cluster = SimulatedCluster(instances=args.instances, tasks=args.tasks, families=args.families, seed=args.seed)
+    print('Simulated %d instances, %d tasks and %d families in %.3f seconds (peak memory %d KB)' %
+          (args.instances, args.tasks, args.families, time.time() - start_time, peak_memory_kb()))
+
+    benchmark_results = run_benchmark(simulated_cluster, args.collectors or ['task-count', 'scale-down'],
+                                      cycles=args.cycles, latency=args.latency, throttle_ratio=args.throttle,
+                                      rate=args.rate, churn=args.churn, stack_name=args.stack_name,
+                                      live_reservation=args.live_reservation, seed=args.seed)
+    print_results(benchmark_results)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(benchmark_results, output, indent=2, sort_keys=True)
@@ -0,0 +1,290 @@
+"""
+Record the AWS and local HTTP traffic of a run to a capture file, and replay runs from it offline
+
+With a Recorder in CAPTURE, every call the clients of a ClientCache make (request, response or error, and how long
+it took) and every read of the ECS agent and EC2 metadata services is written to the capture file, one JSON object
+per line (gzipped if the file name ends in .gz). With a Replayer in CAPTURE, the clients and metadata reads are
+served from the capture file instead, so a run can be reproduced without AWS credentials or network access.
+
+Replayed calls are matched to the recorded ones by service, operation and parameters (ignoring timestamps), in the
+order they were recorded. All timestamps are moved forward by the time since the recording, so time windows such
+as the scale down window see the same datapoints as the recorded run.
+
+"""
+
+import calendar
+import gzip
+import json
+import logging
+import threading
+import time
+import urllib2
+import zlib
+from datetime import datetime, timedelta
+from StringIO import StringIO
+from botocore.exceptions import ClientError
+
+CAPTURE_VERSION = 1
+
+# Recorder or Replayer used by ClientCache and urlopen, if none, talk to AWS and the local services directly
+CAPTURE = None
+
+
+class ReplayError(Exception):
+    ''' A call was made that the capture file has no (more) recorded responses for '''
+
+
+def open_capture_file(path, mode):
+    ''' Open a capture file for writing ('w'), gzipped if the name ends in .gz '''
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+
+def read_capture_file(path):
+    '''
+    Read the lines of a capture file - a gzipped one as far as it was written, even if the run that wrote it died
+    before closing it (and so before writing the gzip trailer gzip.open checks for)
+    '''
+    with open(path, 'rb') as capture_file:
+        data = capture_file.read()
+    if path.endswith('.gz'):
+        members = []
+        # Each entry is flushed as it is written, so everything but the last (half written) line can be decompressed
+        while data:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            members.append(decompressor.decompress(data))
+            data = decompressor.unused_data
+        data = b''.join(members)
+    text = data.decode('utf-8')
+    if text and not text.endswith('\n'):
+        logging.warn('Ignoring the half written last line of %s' % path)
+        text = text[:text.rfind('\n') + 1]
+    return text.splitlines()
+
+
+def encode_value(value):
+    ''' JSON encoding of the values json does not handle - datetimes '''
+    if isinstance(value, datetime):
+        return {'$datetime': calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6}
+    raise TypeError('Unable to record %r' % value)
+
+
+def strip_times(value):
+    ''' A (decoded) request without its timestamps, which differ from run to run '''
+    if isinstance(value, dict):
+        return dict((key, strip_times(value[key])) for key in value if not isinstance(value[key], datetime))
+    if isinstance(value, list):
+        return [strip_times(item) for item in value if not isinstance(item, datetime)]
+    return value
+
+
+def urlopen(request, timeout=None):
+    ''' urllib2.urlopen, recorded or replayed if there is a CAPTURE '''
+    if CAPTURE:
+        return CAPTURE.urlopen(request, timeout)
+    return urllib2.urlopen(request, timeout=timeout)
+
+
+def get_url(request):
+    ''' Method and URL of a urllib2 request (or a plain URL) '''
+    if isinstance(request, urllib2.Request):
+        return request.get_method(), request.get_full_url()
+    return 'GET', request
+
+
+class Recorder(object):
+    '''
+    Writes every call made through it to a capture file
+    :param path: capture file to write
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.capture_file = open_capture_file(path, 'w')
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.count = 0
+        self.write({'version': CAPTURE_VERSION, 'recorded_at': self.started})
+
+    def write(self, entry):
+        ''' Write one entry, straight away, so a run that dies part way still leaves a usable capture '''
+        line = json.dumps(entry, default=encode_value, separators=(',', ':'), sort_keys=True)
+        with self.lock:
+            self.capture_file.write((line + '\n').encode('utf-8'))
+            self.capture_file.flush()
+            self.count += 1
+
+    def client(self, service, region, create_client):
+        ''' Create the real client for service and region, recording every call made with it '''
+        return RecordingClient(create_client(), service, region, self)
+
+    def urlopen(self, request, timeout=None):
+        ''' Read a URL (eg. the ECS agent or EC2 metadata service) and record the response '''
+        method, url = get_url(request)
+        entry = {'service': 'http', 'method': method, 'url': url, 'offset': time.time() - self.started}
+        start_time = time.time()
+        try:
+            body = urllib2.urlopen(request, timeout=timeout).read()
+        except urllib2.HTTPError as e:
+            entry.update({'duration': time.time() - start_time, 'status': e.code, 'reason': str(e.msg)})
+            self.write(entry)
+            raise
+        except urllib2.URLError as e:
+            entry.update({'duration': time.time() - start_time, 'reason': str(e.reason)})
+            self.write(entry)
+            raise
+        entry.update({'duration': time.time() - start_time, 'status': 200, 'body': body.decode('utf-8')})
+        self.write(entry)
+        return StringIO(body)
+
+    def close(self):
+        with self.lock:
+            self.capture_file.close()
+        logging.info('Recorded %d entries to %s' % (self.count - 1, self.path))
+
+
+class RecordingClient(object):
+    '''
+    Wraps a boto3 client and records each call made with it
+    :param client: boto3 client
+    :param service: name of the client's service
+    :param region: region of the client
+    :param recorder: Recorder to write the calls to
+    '''
+
+    def __init__(self, client, service, region, recorder):
+        self.client = client
+        self.service = service
+        self.region = region
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name.startswith('_'):
+            return attribute
+
+        def call(**kwargs):
+            entry = {'service': self.service, 'region': self.region, 'operation': name, 'params': kwargs,
+                     'offset': time.time() - self.recorder.started}
+            start_time = time.time()
+            try:
+                result = attribute(**kwargs)
+            except ClientError as e:
+                entry.update({'duration': time.time() - start_time, 'error': e.response,
+                              'operation_name': e.operation_name})
+                self.recorder.write(entry)
+                raise
+            # The request IDs and HTTP headers are no use offline
+            entry.update({'duration': time.time() - start_time,
+                          'response': dict((key, result[key]) for key in result if key != 'ResponseMetadata')})
+            self.recorder.write(entry)
+            return result
+        return call
+
+
+class Replayer(object):
+    '''
+    Serves the calls recorded in a capture file
+    :param path: capture file to read
+    :param timing: take as long over each call as the recorded call took
+    '''
+
+    def __init__(self, path, timing=False):
+        self.path = path
+        self.timing = timing
+        self.lock = threading.Lock()
+        # (service, region, operation) or ('http', method, url) -> recorded entries, in the order they were made
+        self.entries = {}
+        self.count = 0
+        self.replayed = 0
+
+        lines = read_capture_file(path)
+        header = json.loads(lines[0])
+        if header.get('version') != CAPTURE_VERSION:
+            raise ReplayError('Unable to replay %s - capture version %s, expected %s' %
+                              (path, header.get('version'), CAPTURE_VERSION))
+        shift = timedelta(seconds=time.time() - header['recorded_at'])
+
+        def decode_value(value):
+            if '$datetime' in value:
+                return datetime.utcfromtimestamp(value['$datetime']) + shift
+            return value
+
+        for line in lines[1:]:
+            if not line:
+                continue
+            entry = json.loads(line, object_hook=decode_value)
+            if entry['service'] == 'http':
+                key = ('http', entry['method'], entry['url'])
+            else:
+                key = (entry['service'], entry['region'], entry['operation'])
+            self.entries.setdefault(key, []).append(entry)
+            self.count += 1
+        logging.info('Replaying %d entries from %s' % (self.count, path))
+
+    def next_entry(self, key, params=None):
+        '''
+        Take the next recorded entry for key - the first with the same parameters, or failing that the first
+        :raise ReplayError: if there are no entries left for key
+        '''
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                raise ReplayError('No recorded response left for %s' % ' '.join(key))
+            index = 0
+            if params is not None:
+                params = strip_times(params)
+                matches = [i for i, entry in enumerate(entries) if strip_times(entry['params']) == params]
+                if matches:
+                    index = matches[0]
+                else:
+                    logging.warn('No recorded %s call with parameters %s - replaying the next one recorded' %
+                                 (' '.join(key), params))
+            self.replayed += 1
+            entry = entries.pop(index)
+        if self.timing:
+            time.sleep(entry['duration'])
+        return entry
+
+    def client(self, service, region, create_client=None):
+        ''' A client for service and region that replays the recorded calls '''
+        return ReplayClient(service, region, self)
+
+    def urlopen(self, request, timeout=None):
+        ''' Replay the recorded read of a URL '''
+        method, url = get_url(request)
+        entry = self.next_entry(('http', method, url))
+        if entry.get('status') == 200:
+            return StringIO(entry['body'].encode('utf-8'))
+        if 'status' in entry:
+            raise urllib2.HTTPError(url, entry['status'], entry['reason'], None, None)
+        raise urllib2.URLError(entry['reason'])
+
+    def close(self):
+        logging.info('Replayed %d of the %d entries in %s' % (self.replayed, self.count, self.path))
+
+
+class ReplayClient(object):
+    '''
+    Stands in for a boto3 client, replaying the calls recorded for its service and region
+    :param service: name of the service
+    :param region: region of the client
+    :param replayer: Replayer holding the recorded calls
+    '''
+
+    def __init__(self, service, region, replayer):
+        self.service = service
+        self.region = region
+        self.replayer = replayer
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(**kwargs):
+            entry = self.replayer.next_entry((self.service, self.region, name), kwargs)
+            if 'error' in entry:
+                raise ClientError(entry['error'], entry['operation_name'])
+            return entry['response']
+        return call
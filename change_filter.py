@@ -0,0 +1,117 @@
+"""
+Only send a metric when its value changes, or when a heartbeat is due
+
+Most per-instance task counts are the same from one cycle to the next. ChangeFilter remembers the last value sent
+for each metric and dimension set (in memory, and optionally on local disk), so an unchanged value is only sent again
+once the heartbeat interval has passed - often enough to keep alarms out of INSUFFICIENT_DATA. Cycles are never exactly
+an interval apart, so a heartbeat is due from half an interval before it, in whichever cycle is closest to it. A
+series that is not reported in a cycle (eg. its task family or instance went away) gets one explicit zero and is then forgotten.
+
+Nothing is remembered as sent until commit is called with the entries that failed to send, so a value (or a zero)
+that did not make it to CloudWatch is sent again on the next cycle rather than after the next heartbeat.
+
+"""
+
+import json
+import logging
+import time
+from json_cache import load_json_cache, save_json_cache
+
+# Seconds after which an unchanged value is sent again
+DEFAULT_HEARTBEAT = 5 * 60
+
+# Seconds between cycles, as for the collectors' FREQUENCY
+DEFAULT_INTERVAL = 5 * 60
+
+
+def series_key(namespace, datum):
+    ''' JSON key of the namespace, metric name, dimensions and unit of a MetricData entry '''
+    dimensions = [[dimension['Name'], dimension['Value']] for dimension in datum.get('Dimensions', [])]
+    return json.dumps([namespace, datum['MetricName'], dimensions, datum.get('Unit')])
+
+
+class ChangeFilter(object):
+    '''
+    Last value sent for each metric and dimension set
+    :param heartbeat: seconds after which an unchanged value is sent again
+    :param cache_file: optional path of a JSON file used to keep the last values sent between runs
+    :param interval: seconds between cycles - a heartbeat is due up to half an interval early, so one that falls
+                     a little after a cycle (by jitter) is sent then, rather than a whole interval late
+    '''
+
+    def __init__(self, heartbeat=DEFAULT_HEARTBEAT, cache_file=None, interval=DEFAULT_INTERVAL):
+        self.heartbeat = heartbeat
+        self.tolerance = interval / 2.0
+        self.cache_file = cache_file
+        # series key -> [value, time sent]
+        self.series = {}
+        self.seen = set()
+        self.skipped = 0
+        # Sent (series key -> [value, time]) and gone (series keys) in this cycle, until commit
+        self.sent = {}
+        self.gone = []
+        if cache_file:
+            self.series = load_json_cache(cache_file, 'change')
+
+    def start_cycle(self):
+        ''' Start a new cycle - any series not passed to should_send before finish_cycle is treated as gone '''
+        self.seen = set()
+        self.skipped = 0
+        self.sent = {}
+        self.gone = []
+
+    def should_send(self, namespace, datum, now=None):
+        '''
+        Check whether a MetricData entry (with a Value) needs to be sent, and if so remember it as sent once committed
+        :param now: time of the check, if none provided, use the current time
+        :return: True if the value changed since it was last sent, or the heartbeat is due
+        '''
+        now = now or time.time()
+        key = series_key(namespace, datum)
+        self.seen.add(key)
+        last = self.series.get(key)
+        if last and last[0] == datum['Value'] and now - last[1] < self.heartbeat - self.tolerance:
+            self.skipped += 1
+            return False
+        self.sent[key] = [datum['Value'], now]
+        return True
+
+    def finish_cycle(self):
+        '''
+        Find the series that were not seen in this cycle, to be forgotten once committed
+        :return: list of (namespace, datum) - a zero MetricData entry for each series that went away
+        '''
+        gone = []
+        self.gone = [key for key in self.series if key not in self.seen]
+        for key in self.gone:
+            namespace, metric_name, dimensions, unit = json.loads(key)
+            datum = {
+                'MetricName': metric_name,
+                'Dimensions': [{'Name': name, 'Value': value} for name, value in dimensions],
+                'Value': 0
+            }
+            if unit:
+                datum['Unit'] = unit
+            gone.append((namespace, datum))
+        logging.debug('Skipped %d unchanged metrics, zeroed %d that went away' % (self.skipped, len(gone)))
+        return gone
+
+    def commit(self, failures):
+        '''
+        Remember the values sent and forget the series that went away in this cycle, except where sending failed
+        :param failures: list of (namespace, datum, error) for the entries that could not be sent, as kept in
+                         MetricPublisher.failures
+        '''
+        failed = set(series_key(namespace, datum) for namespace, datum, error in failures)
+        for key in self.sent:
+            if key not in failed:
+                self.series[key] = self.sent[key]
+        for key in self.gone:
+            if key not in failed:
+                self.series.pop(key, None)
+        if failed:
+            logging.debug('%d metrics were not sent - sending them again next cycle' % len(failed))
+        self.sent = {}
+        self.gone = []
+        if self.cache_file:
+            save_json_cache(self.cache_file, self.series, 'change')
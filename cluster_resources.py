@@ -0,0 +1,59 @@
+"""
+Work out a cluster's CPU and memory reservation from its container instances
+
+AWS/ECS CPUReservation and MemoryReservation only reach CloudWatch minutes after the fact. The same figures
+can be computed from the registered and remaining resources of the cluster's container instances, which
+describe_container_instances returns as they are right now - and the same listing gives the cluster size.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import logging
+from pagination import batches, iterate
+from instance_resolver import DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE
+
+# ECS counts the resources of instances in these states towards the cluster reservation
+RESERVATION_STATUSES = ('ACTIVE', 'DRAINING')
+
+
+def get_resource(resources, name):
+    ''' Get the integer value of the named resource (eg. CPU or MEMORY) from a list of resources '''
+    for resource in resources:
+        if resource['name'] == name:
+            return resource.get('integerValue', 0)
+    return 0
+
+
+def get_live_reservation(ecs, cluster):
+    '''
+    Get the current CPU and memory reservation and size of the cluster
+    :param ecs: boto3 ECS client
+    :param cluster: Cluster to query
+    :return: dict with 'CPU' and 'Mem' (percent reserved, None if nothing is registered) and 'size' (number of
+             container instances)
+    '''
+    registered = {'CPU': 0, 'MEMORY': 0}
+    remaining = {'CPU': 0, 'MEMORY': 0}
+    size = 0
+
+    instance_arns = iterate(ecs.list_container_instances, 'containerInstanceArns', cluster=cluster)
+    for batch in batches(instance_arns, DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE):
+        size += len(batch)
+        dci_result = ecs.describe_container_instances(cluster=cluster, containerInstances=batch)
+        for container_instance in dci_result.get('containerInstances', []):
+            if container_instance.get('status') not in RESERVATION_STATUSES:
+                continue
+            for name in registered:
+                registered[name] += get_resource(container_instance.get('registeredResources', []), name)
+                remaining[name] += get_resource(container_instance.get('remainingResources', []), name)
+        for failure in dci_result.get('failures', []):
+            logging.warn('Unable to describe container instance %s: %s' % (failure.get('arn'), failure.get('reason')))
+
+    result = {'size': size}
+    for name, key in (('CPU', 'CPU'), ('MEMORY', 'Mem')):
+        result[key] = None
+        if registered[name]:
+            result[key] = 100.0 * (registered[name] - remaining[name]) / registered[name]
+    logging.debug('Live reservation of cluster %s: %s' % (cluster, result))
+    return result
@@ -0,0 +1,503 @@
+#!/usr/bin/env python
+
+"""
+Run the ECS custom metric collectors in a single long-lived process
+
+The collectors are imported and run in-process on a fixed-rate schedule, sharing one boto3 session and
+set of clients per region across cycles. Cycles start every FREQUENCY seconds regardless of how long the
+collectors take; if a cycle overruns, the missed start times are skipped rather than run back to back.
+
+Any number of cluster/region targets can be collected by one daemon (see --targets). Targets are collected
+concurrently on a bounded thread pool, and a target that is slow or throttled only delays itself.
+
+The stats of each cycle (see cycle_stats) can be served over HTTP with --stats-port, and published as metrics
+with --self-metrics.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import argparse
+import json
+import math
+import os
+import socket
+import threading
+import time
+import logging, logging.handlers
+from multiprocessing.pool import ThreadPool
+import report_task_count_metrics
+import report_scale_down_metric
+from aws_clients import ClientCache, TargetClients, get_instance_metadata
+from agent_introspection import AGENT_URL, EC2_METADATA_URL
+from instance_resolver import InstanceResolver
+from leader_election import LEADER_ELECTION_BACKENDS, build_leader_election
+from metric_publisher import MetricAggregator, MetricPublisher
+from change_filter import ChangeFilter
+from cycle_stats import DEFAULT_STATS_ADDRESS, SELF_METRICS_NAMESPACE, StatsServer
+from reservation_window import DEFAULT_WINDOW_MINUTES, ReservationWindow
+from task_snapshot import TaskCache
+from threshold_provider import DEFAULT_STACK_TTL, ThresholdProvider
+
+DEFAULT_FREQUENCY = 300
+DEFAULT_WORKERS = 8
+
+# Seconds between checks on the targets of a cycle
+POLL_INTERVAL = 0.1
+
+logging.getLogger('botocore').setLevel(logging.CRITICAL)
+
+
+def next_start_time(scheduled, frequency, now):
+    '''
+    Get the start time of the next cycle, on the fixed schedule of one cycle every frequency seconds
+    :return: (next start time, number of start times skipped because the last cycle overran)
+    '''
+    next_start = scheduled + frequency
+    skipped = 0
+    if now > next_start:
+        skipped = int(math.ceil((now - next_start) / float(frequency)))
+        next_start += skipped * frequency
+    return next_start, skipped
+
+
+class Target(object):
+    '''
+    A cluster to collect metrics for
+    :param name: name used in log messages
+    :param region: region of the cluster, metrics are published in this region too
+    :param collectors: list of (name, function) - each function is called with publisher and clients keyword arguments
+    :param samplers: list of (name, function) run on every sample - each function is called with aggregator and
+                     clients keyword arguments
+    :param aggregator: MetricAggregator the samplers add to, sent along with the collectors' metrics
+    :param on_publish: list of functions called with the (namespace, datum, error) failures of each publish, once the
+                       metrics have been sent - eg. to commit a ChangeFilter
+    '''
+
+    def __init__(self, name, region, collectors, samplers=None, aggregator=None, on_publish=None):
+        self.name = name
+        self.region = region
+        self.collectors = collectors
+        self.samplers = samplers or []
+        self.aggregator = aggregator
+        self.on_publish = on_publish or []
+        self.running = threading.Event()
+        # When the current (or last) collection started, None while it is waiting for a worker
+        self.started = None
+
+    def run_collector(self, name, collector, **kwargs):
+        ''' Run one collector (or sampler), return False if it failed '''
+        logging.debug('Running %s for %s' % (name, self.name))
+        try:
+            collector(**kwargs)
+            return True
+        # The collectors exit() when misconfigured - that should not take the daemon down with them
+        except (Exception, SystemExit) as e:
+            logging.exception('Collector %s failed for %s: %s' % (name, self.name, e))
+            return False
+
+    def collect(self, clients, publish=True):
+        '''
+        Take a sample, then (if publish) run every collector for this target once and send their metrics
+        together with the aggregated samples
+        :param clients: TargetClients of this target, given a full retry budget for the cycle
+        '''
+        self.started = time.time()
+        try:
+            clients.start_cycle()
+            if self.samplers:
+                self.aggregator.start_sample()
+                sampled = [self.run_collector(name, sampler, aggregator=self.aggregator, clients=clients)
+                           for name, sampler in self.samplers]
+                # A failed sample (eg. throttled) is no sample at all, rather than zero for every metric
+                if all(sampled):
+                    self.aggregator.finish_sample()
+                else:
+                    logging.warn('Dropping the sample of %s - a sampler failed' % self.name)
+                    self.aggregator.discard_sample()
+            if publish:
+                publisher = MetricPublisher(clients.client('cloudwatch', self.region))
+                for name, collector in self.collectors:
+                    self.run_collector(name, collector, publisher=publisher, clients=clients)
+                with clients.stats.phase('publish'):
+                    if self.aggregator:
+                        self.aggregator.flush(publisher)
+                    publisher.flush()
+                for callback in self.on_publish:
+                    callback(publisher.failures)
+        # Nor should a failed publish (eg. CloudWatch unreachable) - the next cycle tries again
+        except Exception as e:
+            logging.exception('Unable to publish the metrics for %s: %s' % (self.name, e))
+        finally:
+            self.running.clear()
+
+
+class CollectorDaemon(object):
+    '''
+    Collects every target every frequency seconds
+    :param targets: list of Target
+    :param frequency: seconds between the start of each cycle
+    :param clients: ClientCache shared by all cycles and targets - each target gets a retry budget of its own
+    :param workers: number of targets to collect at the same time
+    :param timeout: seconds to wait for a target, from when it starts running, before moving on - if none
+                    provided, use the sample interval
+    :param sample_interval: seconds between samples, if none provided, sample once per cycle
+    :param self_metrics_region: region to publish the stats of each cycle to, if none provided, do not publish them
+    :param collector_name: value of the Collector dimension of the published stats, if none provided, use the host name
+    :param dryrun: log the stats of each cycle rather than publishing them
+    '''
+
+    def __init__(self, targets, frequency, clients, workers=DEFAULT_WORKERS, timeout=None, sample_interval=None,
+                 self_metrics_region=None, collector_name=None, dryrun=False):
+        self.targets = targets
+        self.dryrun = dryrun
+        self.frequency = frequency
+        self.clients = clients
+        self.self_metrics_region = self_metrics_region
+        self.collector_name = collector_name or socket.gethostname()
+        self.sample_interval = sample_interval or frequency
+        self.timeout = timeout or self.sample_interval
+        # A target that uses up its retries (eg. a throttled cluster) leaves the others theirs
+        self.target_clients = dict((target, TargetClients(clients)) for target in targets)
+        self.pool = None
+        self.workers = min(workers, len(targets))
+        if len(targets) > 1:
+            self.pool = ThreadPool(self.workers)
+
+    def run_cycle(self, publish=True, deadline=None):
+        '''
+        Collect every target once - only sampling unless publish
+        :param deadline: time the next cycle is due, if none provided, wait for every target (up to the timeout)
+        '''
+        self.clients.start_cycle()
+        self.clients.stats.start_cycle(self.sample_interval)
+        try:
+            self.collect_targets(publish, deadline)
+        finally:
+            logging.debug(self.clients.stats.summary(self.clients.stats.finish_cycle()))
+
+    def collect_targets(self, publish, deadline=None):
+        '''
+        Collect every target, at most workers at a time and each within the timeout - and never past the deadline,
+        so a slow target cannot make the others miss the next cycle
+        '''
+        if not self.pool:
+            for target in self.targets:
+                target.running.set()
+                target.collect(self.target_clients[target], publish)
+            return
+
+        pending = []
+        for target in self.targets:
+            # A target still running from an earlier cycle is skipped rather than queued up behind itself
+            if target.running.is_set():
+                logging.warn('Skipping %s - still running from a previous cycle' % target.name)
+                continue
+            target.running.set()
+            target.started = None
+            pending.append((target, self.pool.apply_async(target.collect, (self.target_clients[target], publish))))
+
+        # Each target gets the timeout from when it starts running, not from when it was queued
+        while pending:
+            waiting = []
+            for target, result in pending:
+                if result.ready():
+                    try:
+                        result.get()
+                    except Exception as e:
+                        logging.exception('Collecting %s failed: %s' % (target.name, e))
+                elif target.started and time.time() - target.started >= self.timeout:
+                    logging.warn('Timed out after %s seconds waiting for %s' % (self.timeout, target.name))
+                else:
+                    waiting.append((target, result))
+            pending = waiting
+
+            # Finish before the next cycle is due, with time to spare for wrapping up this one
+            if pending and deadline and time.time() + POLL_INTERVAL >= deadline:
+                for target, result in pending:
+                    logging.warn('Leaving %s to run in the background - the next cycle is due' % target.name)
+                break
+
+            # Queued targets cannot start while every worker is held by a target that timed out
+            if pending and not [target for target, result in pending if target.started] and \
+                    len(self.timed_out_targets()) >= self.workers:
+                for target, result in pending:
+                    logging.warn('Leaving %s to run in the background - every worker is busy with a slow target' % target.name)
+                break
+            if pending:
+                pending[0][1].wait(POLL_INTERVAL)
+
+    def timed_out_targets(self):
+        ''' Targets (of this or an earlier cycle) that have been running for longer than the timeout '''
+        now = time.time()
+        return [target for target in self.targets
+                if target.running.is_set() and target.started and now - target.started >= self.timeout]
+
+    def publish_self_metrics(self):
+        ''' Publish the stats of the last cycle as metrics '''
+        if self.dryrun:
+            if self.clients.stats.last:
+                logging.info('Collector stats for %s: %s' % (self.collector_name,
+                                                             self.clients.stats.summary(self.clients.stats.last)))
+            return
+        try:
+            publisher = MetricPublisher(self.clients.client('cloudwatch', self.self_metrics_region))
+            self.clients.stats.put_metrics(publisher, [{'Name': 'Collector', 'Value': self.collector_name}])
+            publisher.flush()
+        except Exception as e:
+            logging.exception('Unable to publish the collector stats: %s' % e)
+
+    def run(self, cycles=None):
+        '''
+        Run cycles (forever if cycles is None) on a fixed-rate schedule - with a sample interval, a cycle is
+        one sample, and metrics are published by the last sample before each frequency boundary
+        '''
+        scheduled = time.time()
+        window_start = scheduled
+        cycle_count = 0
+        while cycles is None or cycle_count < cycles:
+            # Allow for float rounding in the fixed-rate arithmetic
+            publish = scheduled + self.sample_interval >= window_start + self.frequency - 0.001
+            if publish:
+                logging.info('Awoke to post ECS custom metrics')
+            self.run_cycle(publish, scheduled + self.sample_interval)
+            if publish and self.self_metrics_region:
+                self.publish_self_metrics()
+            cycle_count += 1
+            if cycles is not None and cycle_count >= cycles:
+                break
+
+            now = time.time()
+            scheduled, skipped = next_start_time(scheduled, self.sample_interval, now)
+            if skipped:
+                logging.warn('Cycle overran the %s second interval - skipped %d cycle(s)' % (self.sample_interval, skipped))
+            if publish:
+                # One window per publish - only windows that went by without a single sample are skipped
+                window_start += self.frequency
+                if scheduled >= window_start + self.frequency:
+                    missed = int((scheduled - window_start) // self.frequency)
+                    window_start += missed * self.frequency
+                    logging.warn('No samples in the last %d window(s) of %s seconds' % (missed, self.frequency))
+            time.sleep(max(0, scheduled - time.time()))
+
+
+def load_targets(targets_file):
+    '''
+    Read the cluster/region targets from a JSON file, eg.
+        [{"cluster": "prod", "region": "us-east-1", "stack_name": "prod-cluster"},
+         {"cluster": "dev", "region": "eu-west-1", "cpu": 40, "mem": 40, "min_cluster_size": 1}]
+    The scale down thresholds (stack_name or cpu, mem and min_cluster_size) are optional for each target and
+    override the ones given on the command line
+    '''
+    with open(targets_file) as config:
+        targets = json.load(config)
+    for target in targets:
+        if 'cluster' not in target or 'region' not in target:
+            raise ValueError('Every target in %s needs a cluster and a region: %s' % (targets_file, target))
+    return targets
+
+
+def build_target(config, task_count, scale_down, cache_file=None, agent_local=False, leader_election=None,
+                 window_minutes=DEFAULT_WINDOW_MINUTES, live_reservation=False, stack_ttl=DEFAULT_STACK_TTL,
+                 sample=False, storage_resolution=None, heartbeat=None, agent_url=AGENT_URL,
+                 metadata_url=EC2_METADATA_URL, frequency=DEFAULT_FREQUENCY):
+    '''
+    Build a Target from its config (a dict with cluster, region and optionally the scale down thresholds)
+    :param task_count: collect the TaskCount metrics
+    :param scale_down: collect the ScaleDown metric
+    :param cache_file: file to cache container instance to EC2 instance ID mappings in
+    :param agent_local: only collect the TaskCount metrics for *this* instance, from the local ECS agent
+    :param leader_election: LeaderElection deciding whether *this* node collects the cluster-wide metrics
+    :param window_minutes: minutes of CPU and memory reservation to average for the scale down decision
+    :param live_reservation: base the scale down decision on the container instances as they are now
+    :param stack_ttl: seconds to cache the stack parameters for
+    :param sample: sample the TaskCount metrics on every sample and publish them as statistics once per cycle
+    :param storage_resolution: StorageResolution of the sampled TaskCount metrics
+    :param heartbeat: only publish the instance TaskCount metrics that changed, and the unchanged ones every this
+                      many seconds
+    :param agent_url: URL of the ECS agent introspection API
+    :param metadata_url: URL of the EC2 instance metadata service
+    :param frequency: seconds between cycles, for when a heartbeat is due
+    '''
+    region = config['region']
+    cluster = config['cluster']
+
+    instance_resolver = InstanceResolver(cache_file=cache_file)
+    task_cache = TaskCache()
+    local_task_cache = TaskCache()
+    reservation_window = ReservationWindow(window_minutes)
+    threshold_provider = ThresholdProvider(ttl=stack_ttl)
+    change_filter = ChangeFilter(heartbeat, interval=frequency) if heartbeat else None
+
+    collectors = []
+    samplers = []
+    aggregator = None
+    if task_count:
+        def collect_task_count(clients, publisher=None, aggregator=None):
+            report_task_count_metrics.push_task_count_metrics(region=region, cluster=cluster,
+                                                              instance_resolver=instance_resolver,
+                                                              task_cache=task_cache, agent_local=agent_local,
+                                                              leader_election=leader_election,
+                                                              publisher=publisher, clients=clients,
+                                                              aggregator=aggregator, change_filter=change_filter,
+                                                              agent_url=agent_url, metadata_url=metadata_url,
+                                                              local_task_cache=local_task_cache)
+        if sample:
+            aggregator = MetricAggregator(storage_resolution)
+            samplers.append(('report_task_count_metrics', collect_task_count))
+        else:
+            collectors.append(('report_task_count_metrics', collect_task_count))
+    if scale_down:
+        def collect_scale_down(publisher, clients):
+            report_scale_down_metric.push_scale_down_metric(stack_name=config.get('stack_name'),
+                                                            cpu_threshold=config.get('cpu'),
+                                                            mem_threshold=config.get('mem'),
+                                                            min_cluster_size=config.get('min_cluster_size'),
+                                                            region=region, cluster_name=cluster,
+                                                            leader_election=leader_election,
+                                                            reservation_window=reservation_window,
+                                                            live_reservation=live_reservation,
+                                                            threshold_provider=threshold_provider,
+                                                            publisher=publisher, clients=clients)
+        collectors.append(('report_scale_down_metric', collect_scale_down))
+
+    on_publish = [change_filter.commit] if change_filter and not sample else []
+    return Target('%s (%s)' % (cluster, region), region, collectors, samplers, aggregator, on_publish)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Daemon to push custom ECS metrics to CloudWatch on a fixed schedule')
+
+    parser.add_argument("--frequency", help="Seconds between runs, if not provided, will use the FREQUENCY env variable or 300", dest='frequency', type=int, required=False)
+    parser.add_argument("--sample-interval", help="Sample the task counts every this many seconds, and publish them as statistics (min, max, sum and count) every FREQUENCY", dest='sample_interval', type=int, required=False)
+    parser.add_argument("--high-resolution", help="Publish the sampled task counts as high resolution metrics", dest='high_resolution', action='store_true')
+    parser.add_argument("--heartbeat", help="Only push the instance task counts that changed, and the unchanged ones every HEARTBEAT seconds", dest='heartbeat', type=int, required=False)
+    parser.add_argument("--task-count", help="Push the TaskCount metrics", dest='task_count', action='store_true')
+    parser.add_argument("--scale-down", help="Push the ScaleDown metric", dest='scale_down', action='store_true')
+    parser.add_argument("--stack-name", help="Stack name to read scale down thresholds from", dest='stack_name')
+    parser.add_argument("--stack-ttl", help="Seconds to cache the stack parameters for (default %d)" % DEFAULT_STACK_TTL, dest='stack_ttl', type=int, default=DEFAULT_STACK_TTL)
+    parser.add_argument("--cpu", help="CPU Scale down threshold", dest='cpu_threshold')
+    parser.add_argument("--mem", help="MEM Scale down threshold", dest='mem_threshold')
+    parser.add_argument("--min-cluster-size", help="Minimum Cluster Size", dest='min_cluster_size')
+    parser.add_argument("--window", help="Minutes of CPU and Memory reservation to average (default %d)" % DEFAULT_WINDOW_MINUTES, dest='window', type=int, default=DEFAULT_WINDOW_MINUTES)
+    parser.add_argument("--live-reservation", help="Use the CPU and Memory reservation of the container instances right now, rather than from CloudWatch", dest='live_reservation', action='store_true')
+    parser.add_argument("--instance-cache", help="File to cache container instance to EC2 instance ID mappings in between runs", dest='instance_cache', required=False)
+    parser.add_argument("--agent-local", help="Only report task counts for *this* instance, read from the local ECS agent (no ECS API calls)", dest='agent_local', action='store_true')
+    parser.add_argument("--agent-url", help="URL of the ECS agent introspection API (default %s)" % AGENT_URL, dest='agent_url', default=AGENT_URL)
+    parser.add_argument("--metadata-url", help="URL of the EC2 instance metadata service (default %s)" % EC2_METADATA_URL, dest='metadata_url', default=EC2_METADATA_URL)
+    parser.add_argument("--leader-election", help="Run on every instance - each reports its own task counts, an elected leader reports the cluster-wide metrics", dest='leader_election', choices=LEADER_ELECTION_BACKENDS, required=False)
+    parser.add_argument("--lock-file", help="Lease file for the file leader election backend", dest='lock_file', required=False)
+    parser.add_argument("--targets", help="JSON file listing the clusters and regions to collect, if not provided, will use --cluster and --region", dest='targets', required=False)
+    parser.add_argument("--workers", help="Number of targets to collect at the same time (default 8)", dest='workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--target-timeout", help="Seconds to wait for a target, from when it starts running, before moving on - if not provided, will use the frequency", dest='target_timeout', type=int, required=False)
+    parser.add_argument("--stats-port", help="Serve the stats of the last cycle as JSON on this port", dest='stats_port', type=int, required=False)
+    parser.add_argument("--stats-address", help="Address to serve the stats on (default %s)" % DEFAULT_STATS_ADDRESS, dest='stats_address', default=DEFAULT_STATS_ADDRESS)
+    parser.add_argument("--self-metrics", help="Publish the stats of each cycle as metrics in the %s namespace" % SELF_METRICS_NAMESPACE, dest='self_metrics', action='store_true')
+    parser.add_argument("--profile", help="The name of a profile to use. If not given, instance role credentials will be used", dest='profile', required=False)
+    parser.add_argument("--region", help="AWS Region to query, if not provided, will use region for *this* instance", dest='region', required=False)
+    parser.add_argument("--cluster", help="Cluster to query, if not provided, will use cluster *this* instance is in", dest='cluster', required=False)
+    parser.add_argument("--dryrun", help="dryrun mode - don't push any metrics to cloudwatch - print to console", action='store_true')
+    parser.add_argument("--verbose", help="Turn on DEBUG logging", action='store_true', required=False)
+    args = parser.parse_args()
+
+    log_level = logging.INFO
+
+    if args.verbose:
+        print("Verbose logging selected")
+        log_level = logging.DEBUG
+
+    report_task_count_metrics.DRYRUN = args.dryrun
+    report_scale_down_metric.DRYRUN = args.dryrun
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.DEBUG)
+    # create console handler using level set in log_level
+    ch = logging.StreamHandler()
+    ch.setLevel(log_level)
+    console_formatter = logging.Formatter('%(levelname)8s: %(message)s')
+    ch.setFormatter(console_formatter)
+    logger.addHandler(ch)
+
+    if not args.task_count and not args.scale_down:
+        logger.critical('Unable to proceed - please select at least one of --task-count or --scale-down')
+        exit(1)
+
+    frequency = args.frequency
+    if not frequency:
+        frequency = int(os.environ.get('FREQUENCY', DEFAULT_FREQUENCY))
+
+    if args.sample_interval and not 0 < args.sample_interval <= frequency:
+        logger.critical('Unable to proceed - the sample interval must be between 1 second and the frequency (%s seconds)' % frequency)
+        exit(1)
+
+    if args.sample_interval and args.heartbeat:
+        # The sampled task counts are always sent, as statistics, once per FREQUENCY
+        logger.critical('Unable to proceed - please provide either --sample-interval OR --heartbeat')
+        exit(1)
+
+    if args.sample_interval and args.sample_interval < frequency and args.task_count and not args.agent_local:
+        # Only the local ECS agent is cheap to sample - a cluster scan pages through every task in the cluster
+        logger.warn('Every %s second sample scans the whole cluster%s - with many tasks the samples overrun and are '
+                    'skipped, consider --agent-local or a longer --sample-interval' %
+                    (args.sample_interval, ' on the leader' if args.leader_election else ''))
+
+    if args.targets and args.leader_election:
+        logger.critical('Unable to proceed - leader election is only for a daemon running on every instance of one cluster, not with --targets')
+        exit(1)
+
+    if args.targets and args.agent_local:
+        # The local task list would be reported under every target's Cluster dimension
+        logger.critical('Unable to proceed - --agent-local only reports the tasks of *this* instance, in its own cluster, not with --targets')
+        exit(1)
+
+    clients = ClientCache(profile=args.profile)
+    leader_election = None
+
+    if args.targets:
+        target_configs = load_targets(args.targets)
+    else:
+        # Only ask the metadata service once, rather than on every cycle
+        region = args.region
+        cluster = args.cluster
+        if not region or not cluster or args.leader_election:
+            instance_metadata = get_instance_metadata(args.agent_url + '/v1/metadata')
+            if not region:
+                region = instance_metadata['region']
+            if not cluster:
+                cluster = instance_metadata['cluster']
+            if args.leader_election:
+                leader_election = build_leader_election(args.leader_election, clients, region, cluster, lock_file=args.lock_file,
+                                                        node_id=instance_metadata['container_instance_arn'])
+        target_configs = [{'cluster': cluster, 'region': region}]
+
+    targets = []
+    for config in target_configs:
+        if not config.get('stack_name') and not config.get('cpu'):
+            config['stack_name'] = args.stack_name
+            config['cpu'] = args.cpu_threshold
+            config['mem'] = args.mem_threshold
+            config['min_cluster_size'] = args.min_cluster_size
+        if args.scale_down and not config.get('stack_name') and (not config.get('cpu') or not config.get('mem') or not config.get('min_cluster_size')):
+            logger.critical('Unable to proceed - please provide either a stack name OR CPU and Memory thresholds for %s' % config['cluster'])
+            exit(1)
+        cache_file = args.instance_cache
+        if cache_file and len(target_configs) > 1:
+            # Each target keeps its own cache
+            cache_file = '%s.%s.%s' % (cache_file, config['region'], config['cluster'])
+        targets.append(build_target(config, args.task_count, args.scale_down, cache_file, args.agent_local, leader_election,
+                                    args.window, args.live_reservation, args.stack_ttl,
+                                    bool(args.sample_interval), 1 if args.high_resolution else None, args.heartbeat,
+                                    agent_url=args.agent_url, metadata_url=args.metadata_url, frequency=frequency))
+
+    logger.info('Will collect %s every %s seconds' % (', '.join([target.name for target in targets]), frequency))
+    if args.stats_port:
+        StatsServer(clients.stats, args.stats_port, args.stats_address).start()
+
+    self_metrics_region = None
+    if args.self_metrics:
+        self_metrics_region = args.region or target_configs[0]['region']
+
+    CollectorDaemon(targets, frequency, clients, workers=args.workers, timeout=args.target_timeout,
+                    sample_interval=args.sample_interval, self_metrics_region=self_metrics_region,
+                    dryrun=args.dryrun).run()
@@ -0,0 +1,161 @@
+"""
+Time each collection cycle and count the API calls it makes
+
+CycleStats keeps the time spent in each phase of a cycle (listing instances, taking the task snapshot, building the
+metrics, publishing them...), the number of calls, errors and time spent for each API operation, and the length of
+the cycle against its interval. The stats of the last cycle can be served as JSON by a StatsServer, and published as
+metrics in the SELF_METRICS_NAMESPACE namespace.
+
+Listing and describing tasks overlap (task ARNs are described as the pages of the listing come in), so their phase
+is timed as one, and the time spent in each API operation tells the two apart.
+
+"""
+
+import BaseHTTPServer
+import copy
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+SELF_METRICS_NAMESPACE = 'ECS/Collector'
+
+DEFAULT_STATS_ADDRESS = '127.0.0.1'
+
+
+def new_cycle(interval=None):
+    ''' Empty stats for a cycle starting now '''
+    return {'started': time.time(), 'interval': interval, 'duration': None, 'phases': {}, 'calls': {},
+            'errors': {}, 'call_time': {}}
+
+
+class CycleStats(object):
+    ''' Stats of the cycle in progress and of the last completed cycle '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = new_cycle()
+        self.last = None
+        self.cycles = 0
+        self.overruns = 0
+
+    def start_cycle(self, interval=None):
+        '''
+        Start recording a new cycle
+        :param interval: seconds the cycle should finish within
+        '''
+        with self.lock:
+            self.current = new_cycle(interval)
+
+    def finish_cycle(self):
+        '''
+        Finish the cycle in progress
+        :return: the stats of the cycle
+        '''
+        with self.lock:
+            cycle = self.current
+            cycle['duration'] = time.time() - cycle['started']
+            self.cycles += 1
+            if cycle['interval'] and cycle['duration'] > cycle['interval']:
+                self.overruns += 1
+            self.last = cycle
+            self.current = new_cycle(cycle['interval'])
+        return cycle
+
+    @contextmanager
+    def phase(self, name):
+        ''' Add the time spent in the with block to the named phase of the cycle in progress, summed over targets '''
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start_time
+            with self.lock:
+                self.current['phases'][name] = self.current['phases'].get(name, 0) + duration
+
+    def record_call(self, operation, duration, error_code=None):
+        ''' Count one call of an API operation, and its error code if it failed '''
+        with self.lock:
+            cycle = self.current
+            cycle['calls'][operation] = cycle['calls'].get(operation, 0) + 1
+            cycle['call_time'][operation] = cycle['call_time'].get(operation, 0) + duration
+            if error_code:
+                errors = cycle['errors'].setdefault(operation, {})
+                errors[error_code] = errors.get(error_code, 0) + 1
+
+    def report(self):
+        ''' All the stats, as a dict that can be dumped to JSON '''
+        with self.lock:
+            # A copy, as the cycle in progress keeps changing while the report is dumped
+            return {'cycles': self.cycles, 'overruns': self.overruns, 'last_cycle': self.last,
+                    'current_cycle': dict(copy.deepcopy(self.current), duration=time.time() - self.current['started'])}
+
+    def summary(self, cycle):
+        ''' One line description of a cycle's stats, for the log '''
+        errors = sum(sum(codes.values()) for codes in cycle['errors'].values())
+        phases = ', '.join(['%s %.2fs' % (name, cycle['phases'][name]) for name in sorted(cycle['phases'])])
+        return 'Cycle took %.2f seconds (%s), %d API calls, %d errors' % (
+            cycle['duration'], phases or 'no phases', sum(cycle['calls'].values()), errors)
+
+    def put_metrics(self, publisher, dimensions):
+        '''
+        Put the stats of the last completed cycle in publisher, in the SELF_METRICS_NAMESPACE namespace
+        :param dimensions: list of {Name, Value} dimensions to put the metrics with, eg. the collector's host name
+        '''
+        cycle = self.last
+        if not cycle:
+            return
+
+        def put(metric_name, value, unit, extra_dimensions=None):
+            publisher.put(SELF_METRICS_NAMESPACE, {
+                'MetricName': metric_name,
+                'Dimensions': dimensions + (extra_dimensions or []),
+                'Value': value,
+                'Unit': unit
+            })
+
+        put('CycleDuration', cycle['duration'], 'Seconds')
+        if cycle['interval']:
+            # Over 100 means collection no longer fits in its interval
+            put('CycleUtilization', 100.0 * cycle['duration'] / cycle['interval'], 'Percent')
+        put('ApiCalls', sum(cycle['calls'].values()), 'Count')
+        put('ApiErrors', sum(sum(codes.values()) for codes in cycle['errors'].values()), 'Count')
+        for name in cycle['phases']:
+            put('PhaseDuration', cycle['phases'][name], 'Seconds', [{'Name': 'Phase', 'Value': name}])
+
+
+class StatsServer(object):
+    '''
+    Serves the report of a CycleStats as JSON over HTTP, from a background thread
+    :param stats: CycleStats to serve
+    :param port: port to listen on
+    :param address: address to listen on, if none provided, only listen locally
+    '''
+
+    def __init__(self, stats, port, address=DEFAULT_STATS_ADDRESS):
+        class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.rstrip('/') not in ('', '/stats'):
+                    handler.send_error(404)
+                    return
+                body = json.dumps(stats.report(), indent=2, sort_keys=True).encode()
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'application/json')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                logging.debug('Stats request from %s: %s' % (handler.client_address[0], format % args))
+
+        self.server = BaseHTTPServer.HTTPServer((address, port), StatsHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        logging.info('Serving collector stats on http://%s:%d/stats' % self.server.server_address[:2])
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
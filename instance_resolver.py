@@ -0,0 +1,95 @@
+"""
+Resolve ECS container instance ARNs to EC2 instance IDs
+
+The mapping never changes for the life of a container instance, so resolved IDs are cached (optionally
+on local disk) and only newly joined instances are described, in batches of up to 100 ARNs.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import logging
+import time
+from json_cache import load_json_cache, save_json_cache
+from pagination import iterate
+
+# describe_container_instances accepts at most this many ARNs per call
+DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE = 100
+
+# Re-describe a cached instance after this many seconds, just in case
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+
+UNKNOWN_INSTANCE_ID = 'Unknown'
+
+
+def iter_cluster_instances(ecs, cluster):
+    '''Yield the ARNs of the active container instances in the cluster, a page at a time'''
+    return iterate(ecs.list_container_instances, 'containerInstanceArns', cluster=cluster, status='ACTIVE')
+
+
+class InstanceResolver(object):
+    '''
+    TTL cache of container instance ARN -> EC2 instance ID, per cluster
+    :param cache_file: optional path of a JSON file used to keep the cache between runs
+    :param ttl: seconds before a cached entry is described again
+    '''
+
+    def __init__(self, cache_file=None, ttl=DEFAULT_CACHE_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.cache = {}
+        if cache_file:
+            self.cache = load_json_cache(cache_file, 'instance')
+
+    def resolve(self, ecs, cluster, instance_arns):
+        '''
+        Map the given container instance ARNs to EC2 instance IDs
+        :param ecs: boto3 ECS client
+        :param cluster: Cluster the container instances belong to
+        :param instance_arns: iterable of the container instance ARNs currently in the cluster, eg. from
+                              iter_cluster_instances - any other cached ARNs for this cluster are evicted
+        :return: dict of container instance ARN -> EC2 instance ID ('Unknown' if it could not be resolved)
+        '''
+        now = time.time()
+        cluster_cache = self.cache.setdefault(cluster, {})
+        described = 0
+
+        def describe(batch):
+            dci_result = ecs.describe_container_instances(cluster=cluster, containerInstances=batch)
+            for container_instance in dci_result.get('containerInstances', []):
+                if 'ec2InstanceId' in container_instance:
+                    cluster_cache[container_instance['containerInstanceArn']] = [container_instance['ec2InstanceId'], now]
+            for failure in dci_result.get('failures', []):
+                logging.warn('Unable to describe container instance %s: %s' % (failure.get('arn'), failure.get('reason')))
+            for arn in batch:
+                instance_list[arn] = cluster_cache[arn][0] if arn in cluster_cache else UNKNOWN_INSTANCE_ID
+
+        # Describe the new (or expired) instances in full batches as they turn up
+        instance_list = {}
+        to_describe = []
+        for arn in instance_arns:
+            if arn in cluster_cache and now - cluster_cache[arn][1] <= self.ttl:
+                instance_list[arn] = cluster_cache[arn][0]
+                continue
+            to_describe.append(arn)
+            if len(to_describe) >= DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE:
+                describe(to_describe)
+                described += len(to_describe)
+                to_describe = []
+        if to_describe:
+            describe(to_describe)
+            described += len(to_describe)
+        changed = described > 0
+
+        # Evict instances that have left the cluster
+        for arn in [arn for arn in cluster_cache if arn not in instance_list]:
+            del cluster_cache[arn]
+            changed = True
+
+        logging.debug('Resolved %d container instances in cluster %s (%d described)' %
+                      (len(instance_list), cluster, described))
+
+        if changed and self.cache_file:
+            save_json_cache(self.cache_file, self.cache, 'instance')
+
+        return instance_list
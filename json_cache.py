@@ -0,0 +1,44 @@
+"""
+Keep a cache between runs in a JSON file on local disk
+
+A missing or unreadable cache file is treated as an empty cache, and a failed write only logs a warning - losing
+a cache costs a few extra API calls on the next run, never the run itself.
+
+"""
+
+import json
+import logging
+import os
+
+
+def load_json_cache(path, name):
+    '''
+    Read a cache from a JSON file
+    :param path: cache file to read
+    :param name: what is cached, for the log, eg. 'instance'
+    :return: the cached dict, or an empty dict if the file is missing or unreadable
+    '''
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError) as e:
+        logging.warn('Unable to read %s cache %s: %s' % (name, path, e))
+        return {}
+
+
+def save_json_cache(path, cache, name):
+    '''
+    Write a cache to a JSON file (via a temporary file so a partial write is never read back)
+    :param path: cache file to write
+    :param cache: dict to write
+    :param name: what is cached, for the log, eg. 'instance'
+    '''
+    temp_file = path + '.tmp'
+    try:
+        with open(temp_file, 'w') as cache_file:
+            json.dump(cache, cache_file)
+        os.rename(temp_file, path)
+    except (IOError, OSError) as e:
+        logging.warn('Unable to write %s cache %s: %s' % (name, path, e))
@@ -0,0 +1,180 @@
+"""
+Choose one node to report the cluster-wide metrics
+
+When the collectors run on every instance in a cluster, each node only needs to report the metrics for
+its own instance - the cluster-wide TaskCount and ScaleDown metrics only need one node to scan the cluster.
+The backends here decide whether *this* node is that leader:
+
+  EcsLeaderElection  - the live container instance with the lowest ARN leads. Needs no extra infrastructure - the
+                       leader renews a heartbeat attribute on its own container instance. When the leader leaves
+                       the cluster, its agent disconnects or its heartbeat expires (eg. the collector stopped),
+                       the next lowest ARN takes over on its next check.
+  FileLeaderElection - a lease held in a local file. For tests, or nodes sharing a file system.
+
+"""
+
+import fcntl
+import json
+import logging
+import os
+import time
+from aws_clients import get_instance_metadata
+from instance_resolver import DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE, iter_cluster_instances
+from pagination import batches
+
+LEADER_ELECTION_BACKENDS = ['ecs', 'file']
+
+# Seconds to trust a leadership decision before checking again
+DEFAULT_CHECK_INTERVAL = 30
+
+# Seconds a file lease (or ECS heartbeat) is held for without being renewed
+DEFAULT_LEASE = 600
+
+# Container instance attribute the ECS backend's leader renews its heartbeat in
+HEARTBEAT_ATTRIBUTE = 'ecs-custom-metrics.leader-heartbeat'
+
+
+class LeaderElection(object):
+    '''
+    Base class for the leader election backends - subclasses implement elect()
+    :param node_id: ID of *this* node, eg. its container instance ARN
+    :param check_interval: seconds to remember the result of elect() for
+    '''
+
+    def __init__(self, node_id, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.node_id = node_id
+        self.check_interval = check_interval
+        self.leader = False
+        self.checked_at = None
+
+    def elect(self):
+        ''' Return True if *this* node should be the leader '''
+        raise NotImplementedError
+
+    def is_leader(self):
+        ''' Return True if *this* node is the leader, re-checking at most every check_interval seconds '''
+        now = time.time()
+        if self.checked_at is None or now - self.checked_at >= self.check_interval:
+            leader = self.elect()
+            if leader != self.leader:
+                logging.info('Node %s is %s the leader' % (self.node_id, 'now' if leader else 'no longer'))
+            self.leader = leader
+            self.checked_at = now
+        return self.leader
+
+
+class EcsLeaderElection(LeaderElection):
+    '''
+    The live container instance with the lowest ARN is the leader. An instance is live while its ECS agent is
+    connected and its node keeps renewing a heartbeat (a container instance attribute) - so if the collector on the
+    leader stops, or its agent disconnects, the next lowest ARN takes over once the heartbeat is older than the lease.
+    The leader renews its heartbeat each time it checks, so the lease must be longer than the time between checks.
+    :param ecs: boto3 ECS client
+    :param cluster: Cluster the node belongs to
+    :param lease: seconds a heartbeat lasts without being renewed
+    '''
+
+    def __init__(self, ecs, cluster, node_id, lease=DEFAULT_LEASE, check_interval=DEFAULT_CHECK_INTERVAL):
+        LeaderElection.__init__(self, node_id, check_interval)
+        self.ecs = ecs
+        self.cluster = cluster
+        self.lease = lease
+
+    def elect(self):
+        arns = sorted(iter_cluster_instances(self.ecs, self.cluster))
+        if self.node_id not in arns:
+            logging.warn('Node %s is not an active container instance in cluster %s' % (self.node_id, self.cluster))
+            return False
+
+        # Only the instances with a lower ARN can lead instead of this one - usually the first is live and leads
+        now = time.time()
+        for batch in batches(arns[:arns.index(self.node_id)], DESCRIBE_CONTAINER_INSTANCES_BATCH_SIZE):
+            dci_result = self.ecs.describe_container_instances(cluster=self.cluster, containerInstances=batch)
+            instances = dict((instance['containerInstanceArn'], instance)
+                             for instance in dci_result.get('containerInstances', []))
+            for arn in batch:
+                if arn in instances and self.is_live(instances[arn], now):
+                    return False
+
+        self.renew(now)
+        return True
+
+    def is_live(self, instance, now):
+        ''' Return True if the container instance's agent is connected and its heartbeat has not expired '''
+        if not instance.get('agentConnected'):
+            return False
+        for attribute in instance.get('attributes', []):
+            if attribute['name'] == HEARTBEAT_ATTRIBUTE:
+                try:
+                    return now - float(attribute.get('value')) < self.lease
+                except (TypeError, ValueError):
+                    return False
+        return False
+
+    def renew(self, now):
+        ''' Renew the heartbeat of this node, so the nodes with higher ARNs know it is still leading '''
+        try:
+            self.ecs.put_attributes(cluster=self.cluster, attributes=[{
+                'name': HEARTBEAT_ATTRIBUTE, 'value': str(int(now)),
+                'targetType': 'container-instance', 'targetId': self.node_id}])
+        except Exception as e:
+            # Still the leader - if the heartbeat lapses, another node takes over until it is renewed
+            logging.warn('Unable to renew the leader heartbeat of %s: %s' % (self.node_id, e))
+
+
+class FileLeaderElection(LeaderElection):
+    '''
+    The node holding an unexpired lease in lock_file is the leader - the holder renews its lease each time it
+    checks, and any node can take the lease over once it has expired
+    :param lock_file: path of the lease file
+    :param lease: seconds a lease lasts without being renewed
+    '''
+
+    def __init__(self, lock_file, node_id, lease=DEFAULT_LEASE, check_interval=DEFAULT_CHECK_INTERVAL):
+        LeaderElection.__init__(self, node_id, check_interval)
+        self.lock_file = lock_file
+        self.lease = lease
+
+    def elect(self):
+        fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            holder = {}
+            contents = os.read(fd, 4096)
+            if contents:
+                try:
+                    holder = json.loads(contents.decode())
+                except ValueError:
+                    logging.warn('Ignoring unreadable lease file %s' % self.lock_file)
+
+            now = time.time()
+            if holder.get('node') not in (None, self.node_id) and holder.get('expires', 0) > now:
+                return False
+
+            lease = json.dumps({'node': self.node_id, 'expires': now + self.lease}).encode()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, lease)
+            return True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+
+def build_leader_election(backend, clients, region, cluster, lock_file=None, node_id=None):
+    '''
+    Build the leader election for *this* node
+    :param backend: 'ecs' or 'file'
+    :param clients: ClientCache to get the ECS client from
+    :param lock_file: lease file for the 'file' backend
+    :param node_id: ID of *this* node, if none provided, use the container instance ARN of *this* instance
+    '''
+    if not node_id:
+        node_id = get_instance_metadata()['container_instance_arn']
+    if backend == 'ecs':
+        return EcsLeaderElection(clients.client('ecs', region), cluster, node_id)
+    if backend == 'file':
+        if not lock_file:
+            raise ValueError('The file leader election backend needs a lock file')
+        return FileLeaderElection(lock_file, node_id)
+    raise ValueError('Unknown leader election backend: %s' % backend)
@@ -0,0 +1,189 @@
+"""
+Buffer CloudWatch metric data and send it in as few PutMetricData requests as possible
+
+MetricAggregator can also sit in front of the publisher, to turn many samples of a metric into a single
+StatisticValues entry per window.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import logging
+from botocore.exceptions import ClientError
+
+# PutMetricData limits - entries per request and request payload size
+MAX_METRIC_DATA_PER_REQUEST = 1000
+MAX_REQUEST_SIZE = 1000 * 1000
+
+# Errors that mean a datum in the request was rejected, rather than the request as a whole
+INVALID_DATA_ERRORS = ('InvalidParameterValue', 'InvalidParameterCombination', 'MissingParameter')
+
+
+def estimate_datum_size(datum):
+    '''
+    Estimate how many bytes a MetricData entry adds to a (query encoded) PutMetricData request
+    Every leaf value is sent as &MetricData.member.N.<path>=<value>, so count the path and value of each leaf
+    '''
+    # &MetricData.member.NNNN. prefix on every leaf
+    prefix_size = 24
+
+    def leaf_sizes(value, path_size):
+        if isinstance(value, dict):
+            for key in value:
+                for size in leaf_sizes(value[key], path_size + len(key) + 1):
+                    yield size
+        elif isinstance(value, (list, tuple)):
+            # .member.N. for each item in a list
+            for item in value:
+                for size in leaf_sizes(item, path_size + 12):
+                    yield size
+        else:
+            yield prefix_size + path_size + len(str(value)) + 1
+
+    return sum(leaf_sizes(datum, 0))
+
+
+class MetricPublisher(object):
+    '''
+    Buffers MetricData entries per namespace and packs them into PutMetricData requests
+    :param cloudwatch: boto3 CloudWatch client
+    '''
+
+    def __init__(self, cloudwatch):
+        self.cloudwatch = cloudwatch
+        self.buffers = {}
+        self.buffer_sizes = {}
+        self.failures = []
+        self.request_count = 0
+
+    def put(self, namespace, datum):
+        ''' Add a MetricData entry to the buffer for namespace, sending the buffer first if it is full '''
+        size = estimate_datum_size(datum)
+        buffer = self.buffers.setdefault(namespace, [])
+        if buffer and (len(buffer) >= MAX_METRIC_DATA_PER_REQUEST or
+                       self.buffer_sizes[namespace] + size > MAX_REQUEST_SIZE):
+            self.flush(namespace)
+            buffer = self.buffers.setdefault(namespace, [])
+        buffer.append(datum)
+        self.buffer_sizes[namespace] = self.buffer_sizes.get(namespace, 0) + size
+
+    def flush(self, namespace=None):
+        '''
+        Send everything buffered for namespace (or for all namespaces)
+        :return: list of (namespace, datum, error) for the entries that could not be sent
+        '''
+        namespaces = [namespace] if namespace else list(self.buffers)
+        failures = []
+        for ns in namespaces:
+            metric_data = self.buffers.pop(ns, [])
+            self.buffer_sizes.pop(ns, None)
+            if metric_data:
+                failures.extend(self.send(ns, metric_data))
+        for failed_namespace, datum, error in failures:
+            logging.error('Unable to put metric %s %s to CloudWatch namespace %s: %s' %
+                          (datum.get('MetricName'), str(datum.get('Dimensions')), failed_namespace, error))
+        self.failures.extend(failures)
+        return failures
+
+    def send(self, namespace, metric_data):
+        '''
+        Send one PutMetricData request. PutMetricData rejects the whole request if any entry is invalid,
+        so when that happens split the request to find (and report) the entries that were rejected.
+        '''
+        logging.debug('Putting %d metric data entries to CloudWatch namespace %s' % (len(metric_data), namespace))
+        self.request_count += 1
+        try:
+            response = self.cloudwatch.put_metric_data(Namespace=namespace, MetricData=metric_data)
+            logging.debug(str(response))
+            return []
+        except ClientError as e:
+            error_code = e.response.get('Error', {}).get('Code')
+            if error_code in INVALID_DATA_ERRORS and len(metric_data) > 1:
+                middle = len(metric_data) // 2
+                return self.send(namespace, metric_data[:middle]) + self.send(namespace, metric_data[middle:])
+            return [(namespace, datum, str(e)) for datum in metric_data]
+
+
+class MetricAggregator(object):
+    '''
+    Aggregates samples of metrics locally, per metric and dimension set, so a whole window of samples can be
+    sent as one StatisticValues entry
+
+    Each round of samples is staged until finish_sample, so a round whose sampler failed can be dropped with
+    discard_sample rather than counting as zero for every metric. A metric can be added with a scope (eg. only an
+    elected leader samples the cluster-wide metrics), then only the rounds that covered its scope count as its
+    samples - the rounds without a scope always do.
+    :param storage_resolution: StorageResolution of the entries sent (1 for high resolution), if none provided,
+                               use the CloudWatch default (60)
+    '''
+
+    def __init__(self, storage_resolution=None):
+        self.storage_resolution = storage_resolution
+        self.reset()
+        self.discard_sample()
+
+    def reset(self):
+        # scope -> number of rounds that covered it
+        self.samples = {}
+        self.statistics = {}
+        self.scopes = {}
+
+    def start_sample(self):
+        ''' Start a new round of samples - once finished, a metric missing from it counts as a zero sample for it '''
+        self.discard_sample()
+
+    def discard_sample(self):
+        ''' Drop the round in progress, eg. because its sampler failed - it counts as no sample at all '''
+        self.round = []
+        self.round_scopes = set([None])
+
+    def cover(self, scope):
+        ''' Count the round in progress as a sample of every metric in scope, even if none were added to it '''
+        self.round_scopes.add(scope)
+
+    def add(self, namespace, datum, scope=None):
+        ''' Add a sample (a MetricData entry with a Value) to its metric and dimension set, in the round in progress '''
+        dimensions = tuple((dimension['Name'], dimension['Value']) for dimension in datum.get('Dimensions', []))
+        key = (namespace, datum['MetricName'], dimensions, datum.get('Unit'))
+        self.round.append((key, datum['Value'], scope))
+        self.cover(scope)
+
+    def finish_sample(self):
+        ''' Add the samples of the round in progress to their metrics '''
+        for scope in self.round_scopes:
+            self.samples[scope] = self.samples.get(scope, 0) + 1
+        for key, value, scope in self.round:
+            self.scopes[key] = scope
+            if key not in self.statistics:
+                self.statistics[key] = {'SampleCount': 1, 'Sum': value, 'Minimum': value, 'Maximum': value}
+            else:
+                statistics = self.statistics[key]
+                statistics['SampleCount'] += 1
+                statistics['Sum'] += value
+                statistics['Minimum'] = min(statistics['Minimum'], value)
+                statistics['Maximum'] = max(statistics['Maximum'], value)
+        self.discard_sample()
+
+    def flush(self, publisher):
+        ''' Put one StatisticValues entry for each metric and dimension set in publisher, then start over '''
+        for key in self.statistics:
+            namespace, metric_name, dimensions, unit = key
+            statistics = self.statistics[key]
+            samples = self.samples.get(self.scopes[key], 0)
+            if statistics['SampleCount'] < samples:
+                # Missing from some of the rounds that covered it, ie. zero for those rounds
+                statistics['Minimum'] = min(statistics['Minimum'], 0)
+                statistics['Maximum'] = max(statistics['Maximum'], 0)
+                statistics['SampleCount'] = samples
+            datum = {
+                'MetricName': metric_name,
+                'Dimensions': [{'Name': name, 'Value': value} for name, value in dimensions],
+                'StatisticValues': statistics
+            }
+            if unit:
+                datum['Unit'] = unit
+            if self.storage_resolution:
+                datum['StorageResolution'] = self.storage_resolution
+            publisher.put(namespace, datum)
+        logging.debug('Aggregated %d samples of %d metrics' % (self.samples.get(None, 0), len(self.statistics)))
+        self.reset()
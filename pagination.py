@@ -0,0 +1,41 @@
+"""
+Stream the results of paginated ECS list calls
+
+Pages are fetched one at a time as they are consumed, so the describe and aggregate stages downstream can
+start on the first page before the listing is finished, and nothing holds on to every page at once.
+
+"""
+
+
+def paginate(method, result_key, **query_args):
+    '''
+    Yield each page of result_key from a list call, following nextToken until the last page
+    :param method: client method to call, eg. ecs.list_tasks
+    :param result_key: key of the list in each response, eg. 'taskArns'
+    :param query_args: arguments for every call
+    '''
+    while True:
+        query_result = method(**query_args)
+        yield query_result.get(result_key, [])
+        if not query_result.get('nextToken'):
+            break
+        query_args['nextToken'] = query_result['nextToken']
+
+
+def iterate(method, result_key, **query_args):
+    ''' Yield each item of result_key from a list call, one page at a time '''
+    for page in paginate(method, result_key, **query_args):
+        for item in page:
+            yield item
+
+
+def batches(items, size):
+    ''' Yield successive lists of at most size items from an iterable '''
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,179 @@
+"""
+Pace AWS API calls and retry throttled ones
+
+Every call made through a RateLimitedClient first takes a token from an adaptive token bucket shared by all
+the clients of that service and region. The bucket's rate backs off when AWS throttles a call and creeps back
+up while calls succeed, so collection runs close to the highest rate the account allows. Throttled and
+transiently failed calls (including connection failures and timeouts, as botocore's own retries are turned off)
+are retried with jittered exponential backoff, drawing on a retry budget that is shared by every call in the
+cycle (or every call for one target, see aws_clients.TargetClients) so a struggling cycle gives up rather than
+retrying forever.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import logging
+import random
+import threading
+import time
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+
+# Initial calls per second for each service
+DEFAULT_RATES = {'ecs': 20.0, 'cloudwatch': 50.0, 'cloudformation': 5.0}
+DEFAULT_RATE = 10.0
+
+# The rate never grows beyond this multiple of the initial rate, nor backs off below MIN_RATE
+MAX_RATE_MULTIPLIER = 5
+MIN_RATE = 0.5
+
+# After this many calls in a row without throttling, the rate goes up by RATE_STEP calls per second
+SUCCESS_WINDOW = 10
+RATE_STEP = 1.0
+
+# Retries allowed per cycle, across all calls
+DEFAULT_RETRY_BUDGET = 50
+
+# Backoff before retry n is a random time between 0 and min(BACKOFF_CAP, BACKOFF_BASE * 2**n) seconds
+BACKOFF_BASE = 0.1
+BACKOFF_CAP = 10.0
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+                     'RequestThrottledException', 'RequestLimitExceeded', 'TooManyRequestsException')
+# Also retried, along with connection failures and read timeouts (botocore ConnectionError and HTTPClientError)
+TRANSIENT_ERRORS = ('ServiceUnavailable', 'ServiceUnavailableException', 'InternalFailure', 'InternalError',
+                    'ServerException', 'RequestTimeout', 'RequestTimeoutException')
+
+# Client methods that do not make an API call
+NON_API_METHODS = ('can_paginate', 'close', 'generate_presigned_url', 'get_paginator', 'get_waiter')
+
+
+class AdaptiveRateLimiter(object):
+    '''
+    Token bucket whose rate halves when a call is throttled and grows again while calls succeed
+    :param rate: initial calls per second
+    :param max_rate: highest calls per second, if none provided, MAX_RATE_MULTIPLIER times rate
+    :param burst: most calls that can be made at once after a quiet spell, if none provided, rate
+    '''
+
+    def __init__(self, rate, max_rate=None, burst=None):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate * MAX_RATE_MULTIPLIER)
+        self.burst = float(burst or max(1.0, rate))
+        self.tokens = self.burst
+        self.updated_at = time.time()
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        ''' Wait for, then take, a token '''
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.successes += 1
+            if self.successes >= SUCCESS_WINDOW:
+                self.successes = 0
+                self.rate = min(self.max_rate, self.rate + RATE_STEP)
+
+    def on_throttle(self):
+        with self.lock:
+            self.successes = 0
+            self.rate = max(MIN_RATE, self.rate / 2)
+            logging.debug('Throttled - backing off to %.1f calls per second' % self.rate)
+
+
+class RetryBudget(object):
+    '''
+    Number of retries left in this cycle, shared by every call
+    :param retries: retries allowed per cycle
+    '''
+
+    def __init__(self, retries=DEFAULT_RETRY_BUDGET):
+        self.retries = retries
+        self.remaining = retries
+        self.lock = threading.Lock()
+
+    def reset(self):
+        ''' Start a new cycle with the full budget '''
+        with self.lock:
+            self.remaining = self.retries
+
+    def spend(self):
+        ''' Take a retry from the budget, return False if there are none left '''
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def backoff_time(attempt):
+    ''' Seconds to wait before retry attempt (0 based), with full jitter '''
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
+
+class RateLimitedClient(object):
+    '''
+    Wraps a boto3 client so every API call goes through limiter, and failed calls are retried from budget
+    :param client: boto3 client
+    :param limiter: AdaptiveRateLimiter for the client's service and region
+    :param budget: RetryBudget for the cycle
+    :param stats: CycleStats to record every call (and its outcome) in
+    '''
+
+    def __init__(self, client, limiter, budget, stats=None):
+        self.client = client
+        self.limiter = limiter
+        self.budget = budget
+        self.stats = stats
+
+    def record_call(self, name, start_time, error_code=None):
+        if self.stats:
+            self.stats.record_call(name, time.time() - start_time, error_code)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute) or name.startswith('_') or name in NON_API_METHODS:
+            return attribute
+
+        def call(*args, **kwargs):
+            attempt = 0
+            while True:
+                self.limiter.acquire()
+                start_time = time.time()
+                try:
+                    result = attribute(*args, **kwargs)
+                except (ClientError, BotoConnectionError, HTTPClientError) as e:
+                    if isinstance(e, ClientError):
+                        error_code = e.response.get('Error', {}).get('Code') or 'Unknown'
+                    else:
+                        # Connection failures and read timeouts are always transient
+                        error_code = type(e).__name__
+                    self.record_call(name, start_time, error_code)
+                    if error_code in THROTTLING_ERRORS:
+                        self.limiter.on_throttle()
+                    elif isinstance(e, ClientError) and error_code not in TRANSIENT_ERRORS:
+                        raise
+                    if not self.budget.spend():
+                        logging.warn('Retry budget used up - giving up on %s: %s' % (name, e))
+                        raise
+                    wait = backoff_time(attempt)
+                    logging.debug('Retrying %s in %.2f seconds after %s' % (name, wait, error_code))
+                    time.sleep(wait)
+                    attempt += 1
+                else:
+                    self.record_call(name, start_time)
+                    self.limiter.on_success()
+                    return result
+        return call
@@ -8,12 +8,16 @@ Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
 """
 
 import argparse
-import urllib2
-import json
-import boto3
 import os
-from datetime import datetime, timedelta
 import logging, logging.handlers
+import capture
+from aws_clients import ClientCache, get_instance_metadata
+from metric_publisher import MetricPublisher
+from cluster_resources import get_live_reservation
+from pagination import paginate
+from reservation_window import DEFAULT_WINDOW_MINUTES, ReservationWindow
+from threshold_provider import DEFAULT_STACK_TTL, ThresholdProvider
+from leader_election import LEADER_ELECTION_BACKENDS, build_leader_election
 
 SCALE_DOWN_CPU_RESERVATION = 'ScaleDownCPU'
 SCALE_DOWN_MEM_RESERVATION = 'ScaleDownMemory'
@@ -21,7 +25,15 @@ CLUSTER_MIN_SIZE = 'ClusterMinSize'
 
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 
-def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=None, min_cluster_size=None, region=None, cluster_name=None, profile=None):
+DRYRUN = False
+
+# CPU and memory reservation datapoints, kept for as long as this module is loaded
+RESERVATION_WINDOW = ReservationWindow()
+
+# Stack parameters, kept for as long as this module is loaded
+THRESHOLD_PROVIDER = ThresholdProvider()
+
+def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=None, min_cluster_size=None, region=None, cluster_name=None, profile=None, publisher=None, clients=None, leader_election=None, reservation_window=None, live_reservation=False, threshold_provider=None):
     '''
     For the ECS namespace, push a ScaleDown metric
     :param stack_name: Stack to query for CPU and MEM thresholds for scaling down
@@ -30,13 +42,26 @@ def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=No
     :param region: AWS Region to query, if none provied, use region for *this* instance
     :param cluster_name: Cluster to query, if none provided, use cluster *this* instance is in
     :param profile: aws cli profile to use, if none provided, use role credentials
+    :param publisher: MetricPublisher to buffer metrics in, if none provided, metrics are sent at the end of this run
+    :param clients: ClientCache to get AWS clients from, if none provided, create new clients for this run
+    :param leader_election: LeaderElection for when this runs on every instance in the cluster - only the leader
+                            pushes the ScaleDown metric
+    :param reservation_window: ReservationWindow of the datapoints fetched in earlier runs, if none provided, use RESERVATION_WINDOW
+    :param live_reservation: work out the CPU and MEM reservation (and the cluster size) from the container instances
+                             as they are now, rather than from the lagging CloudWatch reservation metrics
+    :param threshold_provider: ThresholdProvider caching the stack parameters, if none provided, use THRESHOLD_PROVIDER
     '''
+    if not reservation_window:
+        reservation_window = RESERVATION_WINDOW
+    if not threshold_provider:
+        threshold_provider = THRESHOLD_PROVIDER
+
     if not region or not cluster_name:
-        instance_metadata = json.loads(urllib2.urlopen('http://localhost:51678/v1/metadata').read().decode())
+        instance_metadata = get_instance_metadata()
         if not region:
-            region = instance_metadata['ContainerInstanceArn'].split(':')[3]
+            region = instance_metadata['region']
         if not cluster_name:
-            cluster_name = instance_metadata['Cluster']
+            cluster_name = instance_metadata['cluster']
 
     if not stack_name and ( not cpu_threshold or not mem_threshold or not min_cluster_size):
         logging.critical('Unable to proceed - need either stack_name OR cpu and mem thresholds and minimum cluster size')
@@ -49,10 +74,20 @@ def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=No
         logging.debug("Memory Threshold: %s " % mem_threshold)
         logging.debug("Min cluster size: %s " % min_cluster_size)
 
-    session = boto3.session.Session(profile_name=profile, region_name=region)
-    ecs = session.client('ecs')
-    cloudwatch = session.client('cloudwatch')
-    cloudformation = session.client('cloudformation')
+    if not clients:
+        clients = ClientCache(profile=profile)
+    ecs = clients.client('ecs', region)
+    cloudwatch = clients.client('cloudwatch', region)
+    cloudformation = clients.client('cloudformation', region)
+
+    if leader_election and not leader_election.is_leader():
+        logging.info('Not the leader for cluster %s - leaving the ScaleDown metric to the leader' % cluster_name)
+        return
+
+    flush_metrics = False
+    if not publisher:
+        publisher = MetricPublisher(cloudwatch)
+        flush_metrics = True
 
     def put_cloudwatch_metric(scale_down):
         ''' Push the given metric (ScaleDown) to CloudWatch for this cluster '''
@@ -62,82 +97,41 @@ def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=No
 
         logging.debug("Pushing the following metric data to CloudWatch with dimensions: " + str(metric_dimensions))
         logging.debug("   ScaleDown: %d " % scale_down)
-        response = cloudwatch.put_metric_data(
-            Namespace=namespace,
-            MetricData=[
-                {
-                    'MetricName': metric_name,
-                    'Dimensions': metric_dimensions,
-                    'Value': scale_down
-                }
-            ]
-        )
-        logging.debug(str(response))
-
-
-    def get_cluster_cpu_and_mem_reservation(cluster_name, start_time, end_time):
-        '''Get the current cluster CPU reservation'''
-        dimensions = [{'Name': 'ClusterName', 'Value': cluster_name}]
-
-        cpu_metrics = cloudwatch.get_metric_statistics(Namespace='AWS/ECS',
-                                                       MetricName='CPUReservation',
-                                                       Dimensions=dimensions,
-                                                       StartTime=start_time,
-                                                       EndTime=end_time,
-                                                       Period=60,
-                                                       Statistics=['Average'])
-
-        mem_metrics = cloudwatch.get_metric_statistics(Namespace='AWS/ECS',
-                                                       MetricName='MemoryReservation',
-                                                       Dimensions=dimensions,
-                                                       StartTime=start_time,
-                                                       EndTime=end_time,
-                                                       Period=60,
-                                                       Statistics=['Average'])
-
-        avg_cpu = 0
-        if 'Datapoints' in cpu_metrics:
-            total_cpu = 0
-            for datapoint in cpu_metrics['Datapoints']:
-                total_cpu += datapoint['Average']
-            avg_cpu = total_cpu / len(cpu_metrics['Datapoints'])
-        logging.debug('Average CPU over last 5 minutes = %8.2f' % avg_cpu)
-
-        avg_mem = 0
-        if 'Datapoints' in mem_metrics:
-            total_mem = 0
-            for datapoint in mem_metrics['Datapoints']:
-                total_mem += datapoint['Average']
-            avg_mem = total_mem / len(mem_metrics['Datapoints'])
-        logging.debug('Average MEM over last 5 minutes = %8.2f' % avg_mem)
-
-        result = {}
-        result['CPU'] = avg_cpu
-        result['Mem'] = avg_mem
+        publisher.put(namespace, {
+            'MetricName': metric_name,
+            'Dimensions': metric_dimensions,
+            'Value': scale_down
+        })
+
+
+    def get_cluster_cpu_and_mem_reservation(cluster_name):
+        '''Get the average cluster CPU and memory reservation over the reservation window'''
+        reservation_window.update(cloudwatch, cluster_name)
+        result = reservation_window.averages(cluster_name)
+        for key in result:
+            if result[key] is None:
+                logging.warn('No %s reservation datapoints for cluster %s in the last %d minutes' % (key, cluster_name, reservation_window.window_minutes))
+            else:
+                logging.debug('Average %s over last %d minutes = %8.2f' % (key, reservation_window.window_minutes, result[key]))
         return result
 
 
-    def get_current_cluster_size(cluster_name, next_token='', max_results=50):
+    def get_current_cluster_size(cluster_name):
+        '''Count the container instances in the cluster, a page at a time'''
         instance_count = 0
-        lci_result = ecs.list_container_instances(cluster=cluster_name, nextToken=next_token, maxResults=max_results)
-        if 'nextToken' in lci_result:
-            instance_count += max_results
-            instance_count += get_current_cluster_size(cluster_name, next_token=lci_result['nextToken'], max_results=max_results)
-        else:
-            if 'containerInstanceArns' in lci_result:
-                instance_count = len(lci_result['containerInstanceArns'])
+        for page in paginate(ecs.list_container_instances, 'containerInstanceArns', cluster=cluster_name):
+            instance_count += len(page)
         return instance_count
 
 
     def get_stack_parameters(stack_name):
         '''Get the thresholds for CPU and Memory for scaling down from the stack'''
-        ds_result = cloudformation.describe_stacks(StackName=stack_name)
-        if 'Stacks' in ds_result:
-            if 'Parameters' in ds_result['Stacks'][0]:
-                return ds_result['Stacks'][0]['Parameters']
+        return threshold_provider.get_parameters(cloudformation, stack_name)
 
+    stats = clients.stats
     if stack_name:
-        stack_params = get_stack_parameters(stack_name)
+        with stats.phase('thresholds'):
+            stack_params = get_stack_parameters(stack_name)
         for param in stack_params:
             if param['ParameterKey'] == SCALE_DOWN_CPU_RESERVATION:
                 cpu_threshold = int(param['ParameterValue'])
@@ -153,17 +147,18 @@ def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=No
         logging.critical('Not able to determine scale down CPU or Memory thresholds or Mimumum cluster size - aborting')
         exit(1)
 
-    # Get end_time - now
-    # Get start_time - 5 minutes ago
-    end_time = datetime.utcnow()
-    end_time_utc = end_time.isoformat()
-    start_time = end_time - timedelta(minutes=5)
-    start_time_utc = start_time.isoformat()
-
-    avg_stats = get_cluster_cpu_and_mem_reservation(cluster_name, start_time_utc, end_time_utc)
+    current_cluster_size = None
+    with stats.phase('reservation'):
+        if live_reservation:
+            # One scan of the container instances gives the reservation and the cluster size
+            avg_stats = get_live_reservation(ecs, cluster_name)
+            current_cluster_size = avg_stats['size']
+        else:
+            avg_stats = get_cluster_cpu_and_mem_reservation(cluster_name)
 
+    # No datapoints means no scale down
     scale_down_cpu = False
-    if 'CPU' in avg_stats:
+    if avg_stats['CPU'] is not None:
         if int(avg_stats['CPU']) < int(cpu_threshold):
             logging.debug('Based on CPU, need a scale down')
             scale_down_cpu = True
@@ -171,14 +166,16 @@ def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=No
             logging.debug('Based on CPU, DO NOT need a scale down')
 
     scale_down_mem = False
-    if 'Mem' in avg_stats:
+    if avg_stats['Mem'] is not None:
         if int(avg_stats['Mem']) < int(mem_threshold):
             logging.debug('Based on Memory, need a scale down')
             scale_down_mem = True
         else:
             logging.debug('Based on Memory, DO NOT need a scale down')
 
-    current_cluster_size = get_current_cluster_size(cluster_name)
+    if current_cluster_size is None:
+        with stats.phase('instances'):
+            current_cluster_size = get_current_cluster_size(cluster_name)
     logging.debug('Current cluster size: %s' % str(int(current_cluster_size)))
 
     scale_down_metric = 0
@@ -195,18 +192,31 @@ def push_scale_down_metric(stack_name=None, cpu_threshold=None, mem_threshold=No
     else:
         logging.info('Scale Down Metric: %s' % scale_down_metric)
 
+    if flush_metrics:
+        with stats.phase('publish'):
+            publisher.flush()
+
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Script to push custom ECS scale down metric to CloudWatch')
 
     parser.add_argument("--stack-name", help="Stack name to read from", dest='stack_name')
+    parser.add_argument("--stack-cache", help="File to cache the stack parameters in between runs", dest='stack_cache', required=False)
+    parser.add_argument("--stack-ttl", help="Seconds to cache the stack parameters for (default %d)" % DEFAULT_STACK_TTL, dest='stack_ttl', type=int, default=DEFAULT_STACK_TTL)
     parser.add_argument("--cpu", help="CPU Scale down threshold", dest='cpu_threshold')
     parser.add_argument("--mem", help="MEM Scale down threshold", dest='mem_threshold')
     parser.add_argument("--min-cluster-size", help="Minimum Cluster Size", dest='min_cluster_size')
+    parser.add_argument("--window", help="Minutes of CPU and Memory reservation to average (default %d)" % DEFAULT_WINDOW_MINUTES, dest='window', type=int, default=DEFAULT_WINDOW_MINUTES)
+    parser.add_argument("--live-reservation", help="Use the CPU and Memory reservation of the container instances right now, rather than from CloudWatch", dest='live_reservation', action='store_true')
     parser.add_argument("--profile", help="The name of a profile to use. If not given, instance role credentials will be used", dest='profile', required=False)
     parser.add_argument("--region", help="AWS Region to query, if not provided, will use region for *this* instance", dest='region', required=False)
     parser.add_argument("--cluster", help="Cluster to query, if not provided, will use cluster *this* instance is in", dest='cluster', required=False)
+    parser.add_argument("--leader-election", help="Run on every instance - only an elected leader pushes the ScaleDown metric", dest='leader_election', choices=LEADER_ELECTION_BACKENDS, required=False)
+    parser.add_argument("--lock-file", help="Lease file for the file leader election backend", dest='lock_file', required=False)
+    parser.add_argument("--record", help="Record the AWS calls and metadata reads of this run to a capture file (gzipped if it ends in .gz)", dest='record', required=False)
+    parser.add_argument("--replay", help="Run offline, replaying the AWS calls and metadata reads recorded in a capture file", dest='replay', required=False)
+    parser.add_argument("--replay-timing", help="With --replay, take as long over each call as the recorded call took", dest='replay_timing', action='store_true')
     parser.add_argument("--dryrun", help="dryrun mode - don't push any metrics to cloudwatch - print to console", action='store_true')
     parser.add_argument("--verbose", help="Turn on DEBUG logging", action='store_true', required=False)
     args = parser.parse_args()
@@ -230,14 +240,43 @@ if __name__ == "__main__":
     ch.setFormatter(console_formatter)
     logger.addHandler(ch)
 
+    if args.record and args.replay:
+        logger.critical('Unable to proceed - please provide either --record OR --replay')
+        exit(1)
+    if args.record:
+        capture.CAPTURE = capture.Recorder(args.record)
+    elif args.replay:
+        capture.CAPTURE = capture.Replayer(args.replay, timing=args.replay_timing)
+
     if not args.stack_name and (not args.cpu_threshold or not args.mem_threshold or not args.min_cluster_size):
         logger.critical('Unable to proceed - please provide either a stack name OR CPU and Memory thresholds')
         exit(1)
 
-    push_scale_down_metric(stack_name=args.stack_name,
-                           cpu_threshold=args.cpu_threshold,
-                           mem_threshold=args.mem_threshold,
-                           min_cluster_size=args.min_cluster_size,
-                           region=args.region,
-                           cluster_name=args.cluster,
-                           profile=args.profile)
+    clients = ClientCache(profile=args.profile)
+    # A failed (eg. throttled) run is the one most worth capturing, so its capture and stats are kept too
+    try:
+        region = args.region
+        cluster = args.cluster
+        leader_election = None
+        if args.leader_election:
+            instance_metadata = get_instance_metadata()
+            region = region or instance_metadata['region']
+            cluster = cluster or instance_metadata['cluster']
+            leader_election = build_leader_election(args.leader_election, clients, region, cluster, lock_file=args.lock_file,
+                                                    node_id=instance_metadata['container_instance_arn'])
+
+        push_scale_down_metric(stack_name=args.stack_name,
+                               cpu_threshold=args.cpu_threshold,
+                               mem_threshold=args.mem_threshold,
+                               min_cluster_size=args.min_cluster_size,
+                               region=region,
+                               cluster_name=cluster,
+                               clients=clients,
+                               leader_election=leader_election,
+                               reservation_window=ReservationWindow(args.window),
+                               live_reservation=args.live_reservation,
+                               threshold_provider=ThresholdProvider(ttl=args.stack_ttl, cache_file=args.stack_cache))
+    finally:
+        logging.info(clients.stats.summary(clients.stats.finish_cycle()))
+        if capture.CAPTURE:
+            capture.CAPTURE.close()
@@ -8,55 +8,80 @@ Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
 """
 
 import argparse
-import urllib2
-import json
-import boto3
 import os
 import logging, logging.handlers
+import capture
+from aws_clients import ClientCache, get_instance_metadata
+from task_snapshot import TaskCache, count_tasks, take_task_snapshot
+from agent_introspection import AGENT_URL, EC2_METADATA_URL, count_agent_tasks, get_agent_task_arns, get_ec2_instance_id
+from leader_election import LEADER_ELECTION_BACKENDS, build_leader_election
+from instance_resolver import UNKNOWN_INSTANCE_ID, InstanceResolver, iter_cluster_instances
+from metric_publisher import MetricPublisher
+from change_filter import DEFAULT_HEARTBEAT, DEFAULT_INTERVAL, ChangeFilter
 
 logging.getLogger('botocore').setLevel(logging.CRITICAL)
 
-def push_task_count_metrics(region=None, cluster=None, profile=None):
+DRYRUN = False
+
+# Container instance -> EC2 instance ID cache, kept for as long as this module is loaded
+INSTANCE_RESOLVER = InstanceResolver()
+
+# Task ARN -> task family cache, kept for as long as this module is loaded
+TASK_CACHE = TaskCache()
+
+# Same, for the tasks on *this* instance with leader election
+LOCAL_TASK_CACHE = TaskCache()
+
+# MetricAggregator scopes of the sampled task counts - with leader election, a node only samples the cluster task
+# counts while it is the leader
+INSTANCE_SCOPE = 'instance'
+CLUSTER_SCOPE = 'cluster'
+
+def push_task_count_metrics(region=None, cluster=None, profile=None, instance_resolver=None, publisher=None, clients=None, task_cache=None, agent_local=False, agent_url=AGENT_URL, leader_election=None, aggregator=None, change_filter=None, metadata_url=EC2_METADATA_URL, local_task_cache=None):
     '''
     For the ECS namespace, push a TaskCount metric, both for *this* instance and the whole cluster
     :param region: AWS Region to query, if none provied, use region for *this* instance
     :param cluster: Cluster to query, if none provided, use cluster *this* instance is in
     :param profile: aws cli profile to use, if none provided, use role credentials
+    :param instance_resolver: InstanceResolver to map container instances to EC2 instance IDs, if none provided, use INSTANCE_RESOLVER
+    :param publisher: MetricPublisher to buffer metrics in, if none provided, metrics are sent at the end of this run
+    :param clients: ClientCache to get AWS clients from, if none provided, create new clients for this run
+    :param task_cache: TaskCache of the tasks described in earlier runs, if none provided, use TASK_CACHE
+    :param agent_local: only push the TaskCount metrics for *this* instance, read from the local ECS agent
+                        without making any ECS API calls
+    :param agent_url: URL of the ECS agent introspection API
+    :param leader_election: LeaderElection for when this runs on every instance in the cluster - every node reports
+                            its own instance (the tasks listed by the local ECS agent, described so TaskFamily means the
+                            same as in the cluster task counts), only the leader reports the cluster task counts
+    :param aggregator: MetricAggregator to add the task counts to as samples, rather than putting them in publisher
+    :param change_filter: ChangeFilter to only put the instance task counts that changed since they were last put (or
+                          are due a heartbeat), and a zero for the instance task counts that went away - if publisher
+                          is provided, the caller commits it with the publisher's failures once it is flushed
+    :param metadata_url: URL of the EC2 instance metadata service, for the EC2 instance ID of *this* instance
+    :param local_task_cache: TaskCache of the tasks on *this* instance described in earlier runs (with leader_election),
+                             if none provided, use LOCAL_TASK_CACHE
     '''
     # Can get the cluster and region from the metadata service if we don't have it
     if not region or not cluster:
-        instance_metadata = json.loads(urllib2.urlopen('http://localhost:51678/v1/metadata').read().decode())
-        instance_arn = instance_metadata['ContainerInstanceArn']
+        instance_metadata = get_instance_metadata(agent_url + '/v1/metadata')
         if not region:
-            region = instance_arn.split(':')[3]
+            region = instance_metadata['region']
         if not cluster:
-            cluster = instance_metadata['Cluster']
+            cluster = instance_metadata['cluster']
+
+    if not instance_resolver:
+        instance_resolver = INSTANCE_RESOLVER
+    if not task_cache:
+        task_cache = TASK_CACHE
+    if not local_task_cache:
+        local_task_cache = LOCAL_TASK_CACHE
 
     namespace = "ECS"
     metric_name = "TaskCount"
 
-    def get_cluster_instances(next_token=None):
-        '''Get the cluster instances in this cluster'''
-        instance_list = {}
-        if next_token:
-            query_result = ecs.list_container_instances(cluster=cluster, status='ACTIVE', nextToken=next_token)
-        else:
-            query_result = ecs.list_container_instances(cluster=cluster, status='ACTIVE')
-
-        if 'ResponseMetadata' in query_result:
-            if 'HTTPStatusCode' in query_result['ResponseMetadata']:
-                if query_result['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    if 'nextToken' in query_result:
-                        instance_list.extend(get_cluster_instances(next_token=query_result['nextToken']))
-                    else:
-                        for inst in query_result['containerInstanceArns']:
-                            inst_id = 'Unknown'
-                            dci_result = ecs.describe_container_instances(cluster=cluster, containerInstances=[inst])
-                            if 'containerInstances' in dci_result:
-                                if 'ec2InstanceId' in dci_result['containerInstances'][0]:
-                                    inst_id = dci_result['containerInstances'][0]['ec2InstanceId']
-                            instance_list[inst] = inst_id
-        return instance_list
+    def get_cluster_instances():
+        '''Get the cluster instances in this cluster, mapped to their EC2 instance IDs'''
+        return instance_resolver.resolve(ecs, cluster, iter_cluster_instances(ecs, cluster))
 
 
     def put_cloudwatch_metric(task_family, count, instance_id=None):
@@ -74,127 +99,149 @@ def push_task_count_metrics(region=None, cluster=None, profile=None):
         logging.debug("Pushing the following metric data to CloudWatch with dimensions: " + str(metric_dimensions))
         logging.debug("   Task Family: %s " % task_family)
         logging.debug("   Count: %s " % str(count))
-        # Do the put
-        response = cloudwatch.put_metric_data(
-            Namespace=namespace,
-            MetricData=[
-                {
-                    'MetricName': metric_name,
-                    'Dimensions': metric_dimensions,
-                    'Value': count,
-                    'Unit': 'Count'
-                },
-            ]
-        )
-
-
-    def get_task_cluster_count(task_name, task_type, next_token=None):
-        '''Get the count of running tasks for the given task'''
-        task_count = 0
-        if task_type == 'service':
-            if next_token:
-                query_result = ecs.list_tasks(cluster=cluster, serviceName=task_name, nextToken=next_token)
-            else:
-                query_result = ecs.list_tasks(cluster=cluster, serviceName=task_name)
+        datum = {
+            'MetricName': metric_name,
+            'Dimensions': metric_dimensions,
+            'Value': count,
+            'Unit': 'Count'
+        }
+        if aggregator:
+            aggregator.add(namespace, datum, INSTANCE_SCOPE if instance_id else CLUSTER_SCOPE)
+        elif instance_id and change_filter:
+            if change_filter.should_send(namespace, datum):
+                publisher.put(namespace, datum)
         else:
-            if next_token:
-                query_result = ecs.list_tasks(cluster=cluster, family=task_name, nextToken=next_token)
+            publisher.put(namespace, datum)
+
+    def report_instance_task_counts(instance_id, instance_task_families):
+        ''' Report the task counts of each task family on the given instance '''
+        if DRYRUN:
+            logging.info('Instance task counts for instance ID %s:' % instance_id)
+        for task_fam in instance_task_families:
+            if not DRYRUN:
+                # Report instance task counts to CloudWatch
+                put_cloudwatch_metric(task_fam, instance_task_families[task_fam]['count'], instance_id)
             else:
-                query_result = ecs.list_tasks(cluster=cluster, family=task_name)
-
-        if 'ResponseMetadata' in query_result:
-            if 'HTTPStatusCode' in query_result['ResponseMetadata']:
-                if query_result['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    if 'nextToken' in query_result:
-                        task_count += len(query_result['taskArns'])
-                        task_count += get_task_cluster_count(task_name, task_type, next_token=query_result['nextToken'])
-                    else:
-                        task_count += len(query_result['taskArns'])
-        return task_count
-
-
-    def get_task_list(instance=None, next_token=None):
-        ''' Get the running tasks '''
-        running_tasks = []
-        if instance:
-            # Get tasks on this instance
-            if next_token:
-                query_result = ecs.list_tasks(cluster=cluster, containerInstance=instance, nextToken=next_token)
+                logging.info('   Task Family: %s, Count: %s, Instance: %s' % (task_fam, instance_task_families[task_fam]['count'], instance_id))
+
+
+    def report_cluster_task_counts(cluster_task_families):
+        ''' Report the task counts of each task family in the cluster '''
+        if aggregator:
+            aggregator.cover(CLUSTER_SCOPE)
+        if DRYRUN:
+            logging.info('Cluster task counts:')
+        for task_fam in cluster_task_families:
+            task_cluster_count = cluster_task_families[task_fam]['count']
+            if not DRYRUN:
+                # Report cluster task counts to CloudWatch
+                put_cloudwatch_metric(task_fam, task_cluster_count)
             else:
-                query_result = ecs.list_tasks(cluster=cluster, containerInstance=instance)
-        else:
-            # Get tasks in this cluster
-            if next_token:
-                query_result = ecs.list_tasks(cluster=cluster, nextToken=next_token)
+                logging.info('   Task Family: %s, Count: %s' % (task_fam, task_cluster_count))
+
+    def get_instance_id(ecs):
+        '''
+        Get the EC2 instance ID of *this* instance - with leader election, by describing its container instance (ECS
+        calls are allowed, and the metadata service may be out of reach, eg. IMDSv2 with a hop limit of 1 from a
+        bridge networked container), otherwise from the metadata service
+        '''
+        if leader_election:
+            container_instance_arn = leader_election.node_id
+            instance_id = instance_resolver.resolve(ecs, cluster, [container_instance_arn])[container_instance_arn]
+            if instance_id != UNKNOWN_INSTANCE_ID:
+                return instance_id
+        return get_ec2_instance_id(metadata_url)
+
+    def report_agent_instance_task_counts():
+        ''' Report the task counts of *this* instance, as listed by the local ECS agent '''
+        with stats.phase('agent'):
+            if leader_election:
+                # Describe the (new) tasks, so a service's tasks are counted under the service name as they are
+                # in the leader's cluster task counts, rather than under their task definition family
+                ecs = clients.client('ecs', region)
+                instance_task_families = count_tasks(ecs, cluster, get_agent_task_arns(agent_url), local_task_cache)
+                instance_id = get_instance_id(ecs) if instance_task_families else None
             else:
-                query_result = ecs.list_tasks(cluster=cluster)
-        if 'ResponseMetadata' in query_result:
-            if 'HTTPStatusCode' in query_result['ResponseMetadata']:
-                if query_result['ResponseMetadata']['HTTPStatusCode'] == 200:
-                    if 'nextToken' in query_result:
-                        running_tasks.extend(query_result['taskArns'])
-                        running_tasks.extend(get_task_list(instance=instance, next_token=query_result['nextToken']))
-                    else:
-                        running_tasks.extend(query_result['taskArns'])
-        return running_tasks
-
-
-    def parse_tasks(task_list):
-        ''' Parse task_list and return a dict containing family:count'''
-        task_families = {}
-        for task in task_list:
-            # Get the task type (service or family)
-            type = task['group'].split(':')[0]
-            # Get the task family for this task
-            family = task['group'].split(':')[-1]
-            if family not in task_families:
-                task_families[family] = {}
-                task_families[family]['type'] = type
-                task_families[family]['count'] = 1
+                instance_task_families = count_agent_tasks(agent_url)
+                instance_id = get_ec2_instance_id(metadata_url) if instance_task_families else None
+        with stats.phase('report'):
+            if len(instance_task_families) > 0:
+                report_instance_task_counts(instance_id, instance_task_families)
             else:
-                task_families[family]['count'] = task_families[family]['count'] + 1
-        return task_families
-
-    session = boto3.session.Session(profile_name=profile, region_name=region)
-    ecs = session.client('ecs')
-    cloudwatch = session.client('cloudwatch')
-
-    instances_to_check = get_cluster_instances()
-
-    cluster_task_families = {}
-    for instance in instances_to_check:
-        # Get running tasks on this instance
-        instance_task_list = get_task_list(instance=instance)
-
-        # Figure out task families from list of tasks
-        if len(instance_task_list) > 0:
-            query_result = ecs.describe_tasks(cluster=cluster, tasks=instance_task_list)
-            instance_task_families = parse_tasks(query_result['tasks'])
-
-            if DRYRUN:
-                logging.info('Instance task counts for instance ID %s:' % instances_to_check[instance])
-            for task_fam in instance_task_families:
-                # Add this task family to the list if not already there
-                if task_fam not in cluster_task_families:
-                    cluster_task_families[task_fam] = instance_task_families[task_fam]['type']
-                if not DRYRUN:
-                    # Report instance task counts to CloudWatch
-                    put_cloudwatch_metric(task_fam, instance_task_families[task_fam]['count'], instances_to_check[instance])
-                else:
-                    logging.info('   Task Family: %s, Count: %s, Instance: %s' % (task_fam, instance_task_families[task_fam]['count'], instances_to_check[instance]))
-        else:
-            logging.warn('Empty task list from instance: %s' % instance)
-
-    if DRYRUN:
-        logging.info('Cluster task counts:')
-    for task_fam in cluster_task_families:
-        task_cluster_count = get_task_cluster_count(task_fam, cluster_task_families[task_fam])
-        if not DRYRUN:
-            # Report cluster task counts to CloudWatch
-            put_cloudwatch_metric(task_fam, task_cluster_count)
+                logging.warn('Empty task list from the local ECS agent')
+            if aggregator:
+                aggregator.cover(INSTANCE_SCOPE)
+
+    def report_leader_cluster_task_counts():
+        ''' Report the task counts of the whole cluster, if *this* node is the leader '''
+        if leader_election and leader_election.is_leader():
+            ecs = clients.client('ecs', region)
+            with stats.phase('tasks'):
+                snapshot = take_task_snapshot(ecs, cluster, task_cache)
+            with stats.phase('report'):
+                report_cluster_task_counts(snapshot['cluster'])
+
+    if not clients:
+        clients = ClientCache(profile=profile)
+    cloudwatch = clients.client('cloudwatch', region)
+
+    flush_metrics = False
+    if not publisher:
+        publisher = MetricPublisher(cloudwatch)
+        flush_metrics = True
+
+    if change_filter and not aggregator and not DRYRUN:
+        change_filter.start_cycle()
+    else:
+        change_filter = None
+
+    stats = clients.stats
+    # Whatever has been put is sent even if a later part fails, eg. the instance task counts when the leader's
+    # cluster scan runs out of retries
+    try:
+        if agent_local or leader_election:
+            failed = []
+            # The instance and the cluster task counts are reported independently, so that eg. an unreachable agent
+            # or metadata service on the leader does not cost the cluster task counts too
+            for name, report in [('instance', report_agent_instance_task_counts),
+                                 ('cluster', report_leader_cluster_task_counts)]:
+                try:
+                    report()
+                except Exception as e:
+                    logging.exception('Unable to report the %s task counts: %s' % (name, e))
+                    failed.append(e)
+            if failed:
+                raise failed[0]
         else:
-            logging.info('   Task Family: %s, Count: %s' % (task_fam, task_cluster_count))
-
+            ecs = clients.client('ecs', region)
+            with stats.phase('instances'):
+                instances_to_check = get_cluster_instances()
+
+            # One snapshot of the whole cluster gives both the instance and the cluster task counts
+            with stats.phase('tasks'):
+                snapshot = take_task_snapshot(ecs, cluster, task_cache)
+
+            with stats.phase('report'):
+                for instance in instances_to_check:
+                    instance_task_families = snapshot['instances'].get(instance, {})
+                    if len(instance_task_families) > 0:
+                        report_instance_task_counts(instances_to_check[instance], instance_task_families)
+                    else:
+                        logging.warn('Empty task list from instance: %s' % instance)
+                if aggregator:
+                    aggregator.cover(INSTANCE_SCOPE)
+
+                report_cluster_task_counts(snapshot['cluster'])
+
+        if change_filter:
+            for gone_namespace, datum in change_filter.finish_cycle():
+                publisher.put(gone_namespace, datum)
+    finally:
+        if flush_metrics:
+            with stats.phase('publish'):
+                publisher.flush()
+            if change_filter:
+                change_filter.commit(publisher.failures)
 
 if __name__ == "__main__":
 
@@ -203,6 +250,17 @@ if __name__ == "__main__":
     parser.add_argument("--profile", help="The name of a profile to use. If not given, instance role credentials will be used", dest='profile', required=False)
     parser.add_argument("--region", help="AWS Region to query, if not provided, will use region for *this* instance", dest='region', required=False)
     parser.add_argument("--cluster", help="Cluster to query, if not provided, will use cluster *this* instance is in", dest='cluster', required=False)
+    parser.add_argument("--instance-cache", help="File to cache container instance to EC2 instance ID mappings in between runs", dest='instance_cache', required=False)
+    parser.add_argument("--agent-local", help="Only report task counts for *this* instance, read from the local ECS agent (no ECS API calls)", dest='agent_local', action='store_true')
+    parser.add_argument("--agent-url", help="URL of the ECS agent introspection API (default %s)" % AGENT_URL, dest='agent_url', default=AGENT_URL)
+    parser.add_argument("--metadata-url", help="URL of the EC2 instance metadata service (default %s)" % EC2_METADATA_URL, dest='metadata_url', default=EC2_METADATA_URL)
+    parser.add_argument("--leader-election", help="Run on every instance - each reports its own task counts, an elected leader reports the cluster task counts", dest='leader_election', choices=LEADER_ELECTION_BACKENDS, required=False)
+    parser.add_argument("--lock-file", help="Lease file for the file leader election backend", dest='lock_file', required=False)
+    parser.add_argument("--heartbeat", help="Only push the instance task counts that changed, and the unchanged ones every HEARTBEAT seconds (eg. %d)" % DEFAULT_HEARTBEAT, dest='heartbeat', type=int, required=False)
+    parser.add_argument("--change-cache", help="File to keep the last instance task counts pushed in between runs (with --heartbeat)", dest='change_cache', required=False)
+    parser.add_argument("--record", help="Record the AWS calls and metadata reads of this run to a capture file (gzipped if it ends in .gz)", dest='record', required=False)
+    parser.add_argument("--replay", help="Run offline, replaying the AWS calls and metadata reads recorded in a capture file", dest='replay', required=False)
+    parser.add_argument("--replay-timing", help="With --replay, take as long over each call as the recorded call took", dest='replay_timing', action='store_true')
     parser.add_argument("--dryrun", help="dryrun mode - don't push any metrics to cloudwatch - print to console", action='store_true')
     parser.add_argument("--verbose", help="Turn on DEBUG logging", action='store_true', required=False)
     args = parser.parse_args()
@@ -226,4 +284,41 @@ if __name__ == "__main__":
     ch.setFormatter(console_formatter)
     logger.addHandler(ch)
 
-    push_task_count_metrics(region=args.region, cluster=args.cluster, profile=args.profile)
+    if args.record and args.replay:
+        logger.critical('Unable to proceed - please provide either --record OR --replay')
+        exit(1)
+    if args.record:
+        capture.CAPTURE = capture.Recorder(args.record)
+    elif args.replay:
+        capture.CAPTURE = capture.Replayer(args.replay, timing=args.replay_timing)
+
+    instance_resolver = None
+    if args.instance_cache:
+        instance_resolver = InstanceResolver(cache_file=args.instance_cache)
+
+    change_filter = None
+    if args.heartbeat:
+        # Runs are FREQUENCY seconds apart when run by command_runner.sh
+        change_filter = ChangeFilter(heartbeat=args.heartbeat, cache_file=args.change_cache,
+                                     interval=int(os.environ.get('FREQUENCY', DEFAULT_INTERVAL)))
+
+    clients = ClientCache(profile=args.profile)
+    # A failed (eg. throttled) run is the one most worth capturing, so its capture and stats are kept too
+    try:
+        region = args.region
+        cluster = args.cluster
+        leader_election = None
+        if args.leader_election:
+            instance_metadata = get_instance_metadata(args.agent_url + '/v1/metadata')
+            region = region or instance_metadata['region']
+            cluster = cluster or instance_metadata['cluster']
+            leader_election = build_leader_election(args.leader_election, clients, region, cluster, lock_file=args.lock_file,
+                                                    node_id=instance_metadata['container_instance_arn'])
+
+        push_task_count_metrics(region=region, cluster=cluster, instance_resolver=instance_resolver, clients=clients,
+                                agent_local=args.agent_local, agent_url=args.agent_url, leader_election=leader_election,
+                                change_filter=change_filter, metadata_url=args.metadata_url)
+    finally:
+        logging.info(clients.stats.summary(clients.stats.finish_cycle()))
+        if capture.CAPTURE:
+            capture.CAPTURE.close()
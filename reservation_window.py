@@ -0,0 +1,101 @@
+"""
+Keep a rolling window of a cluster's CPUReservation and MemoryReservation datapoints
+
+Both series are fetched in one GetMetricData call, and after the first cycle only the minutes newer than the
+latest datapoint already held are requested - so a longer window costs no more per cycle than a short one.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import calendar
+import logging
+from datetime import datetime
+
+DEFAULT_WINDOW_MINUTES = 5
+PERIOD = 60
+
+# GetMetricData query ID -> (metric name, key in the averages)
+RESERVATION_METRICS = {'cpu': ('CPUReservation', 'CPU'), 'mem': ('MemoryReservation', 'Mem')}
+
+
+def to_epoch(timestamp):
+    ''' Seconds since the epoch of a (naive UTC or timezone aware) datetime '''
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+class ReservationWindow(object):
+    '''
+    The last window_minutes of per-minute average CPU and memory reservation, for each cluster
+    :param window_minutes: length of the window
+    '''
+
+    def __init__(self, window_minutes=DEFAULT_WINDOW_MINUTES):
+        self.window_minutes = window_minutes
+        # cluster -> query ID -> epoch seconds -> value
+        self.datapoints = {}
+
+    def update(self, cloudwatch, cluster_name, now=None):
+        '''
+        Fetch the datapoints that are newer than the ones already in the window, and drop those that have
+        fallen out of it
+        :param cloudwatch: boto3 CloudWatch client
+        :param now: end of the window, if none provided, use the current time
+        '''
+        end = to_epoch(now or datetime.utcnow())
+        window_start = end - self.window_minutes * 60
+        series = self.datapoints.setdefault(cluster_name, dict((query_id, {}) for query_id in RESERVATION_METRICS))
+
+        # Only ask for the minutes after the newest datapoint held for *both* series
+        start = window_start
+        newest = [max(series[query_id]) for query_id in series if series[query_id]]
+        if len(newest) == len(series):
+            start = max(start, min(newest) + PERIOD)
+        start -= start % PERIOD
+
+        if start < end:
+            self.fetch(cloudwatch, cluster_name, series, start, end)
+
+        for query_id in series:
+            for timestamp in [timestamp for timestamp in series[query_id] if timestamp < window_start]:
+                del series[query_id][timestamp]
+
+    def fetch(self, cloudwatch, cluster_name, series, start, end):
+        ''' Get both series from start to end in one (paginated) GetMetricData call '''
+        dimensions = [{'Name': 'ClusterName', 'Value': cluster_name}]
+        queries = []
+        for query_id in RESERVATION_METRICS:
+            queries.append({'Id': query_id,
+                            'MetricStat': {'Metric': {'Namespace': 'AWS/ECS',
+                                                      'MetricName': RESERVATION_METRICS[query_id][0],
+                                                      'Dimensions': dimensions},
+                                           'Period': PERIOD,
+                                           'Stat': 'Average'},
+                            'ReturnData': True})
+
+        query_args = {'MetricDataQueries': queries,
+                      'StartTime': datetime.utcfromtimestamp(start),
+                      'EndTime': datetime.utcfromtimestamp(end)}
+        fetched = 0
+        while True:
+            gmd_result = cloudwatch.get_metric_data(**query_args)
+            for result in gmd_result.get('MetricDataResults', []):
+                for timestamp, value in zip(result.get('Timestamps', []), result.get('Values', [])):
+                    series[result['Id']][to_epoch(timestamp)] = value
+                    fetched += 1
+            if not gmd_result.get('NextToken'):
+                break
+            query_args['NextToken'] = gmd_result['NextToken']
+        logging.debug('Fetched %d reservation datapoints for the last %d minutes' % (fetched, (end - start) // 60))
+
+    def averages(self, cluster_name):
+        '''
+        Average reservation over the window
+        :return: dict with 'CPU' and 'Mem' - None if there are no datapoints in the window
+        '''
+        result = {}
+        series = self.datapoints.get(cluster_name, {})
+        for query_id in RESERVATION_METRICS:
+            values = list(series.get(query_id, {}).values())
+            result[RESERVATION_METRICS[query_id][1]] = sum(values) / len(values) if values else None
+        return result
@@ -0,0 +1,145 @@
+"""
+Build a snapshot of the running tasks in an ECS cluster
+
+The cluster is listed once, a page at a time, and the tasks are described in batches as they are listed, so
+both the per-instance and the per-family task counts can be derived from the one snapshot without any further
+ECS calls.
+
+A task's group and container instance never change, so a TaskCache can be kept between snapshots - then
+only tasks started since the last snapshot are described.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import logging
+from pagination import batches, iterate
+
+# describe_tasks accepts at most this many task ARNs per call
+DESCRIBE_TASKS_BATCH_SIZE = 100
+
+
+def iter_cluster_tasks(ecs, cluster):
+    '''Yield the ARNs of the running tasks in the cluster, a page at a time'''
+    return iterate(ecs.list_tasks, 'taskArns', cluster=cluster)
+
+
+def describe_cluster_tasks(ecs, cluster, task_arns):
+    '''Yield the descriptions of the given tasks, describing DESCRIBE_TASKS_BATCH_SIZE at a time'''
+    for batch in batches(task_arns, DESCRIBE_TASKS_BATCH_SIZE):
+        query_result = ecs.describe_tasks(cluster=cluster, tasks=batch)
+        for failure in query_result.get('failures', []):
+            logging.warn('Unable to describe task %s: %s' % (failure.get('arn'), failure.get('reason')))
+        for task in query_result.get('tasks', []):
+            yield task
+
+
+def parse_task_group(group):
+    ''' Split a task group (eg. service:my-service or family:my-task) into its type and family '''
+    parts = group.split(':')
+    return parts[0], parts[-1]
+
+
+def add_task(task_families, family, task_type, count=1):
+    ''' Add count tasks of the given family to a dict of family:{type, count} '''
+    if family not in task_families:
+        task_families[family] = {}
+        task_families[family]['type'] = task_type
+        task_families[family]['count'] = count
+    else:
+        task_families[family]['count'] = task_families[family]['count'] + count
+
+
+class TaskCache(object):
+    '''
+    Task ARN -> (type, family, container instance ARN) for the running tasks of each cluster
+    '''
+
+    def __init__(self):
+        self.tasks = {}
+        self.generations = {}
+
+    def update(self, ecs, cluster, task_arns):
+        '''
+        Bring the cache for cluster in line with the given running tasks - tasks not seen before are described,
+        and once task_arns is exhausted, tasks that are no longer running are evicted
+        :param task_arns: iterable of the running task ARNs, eg. from iter_cluster_tasks
+        :return: generator of (type, family, container instance ARN or None) for the given tasks
+        '''
+        cluster_tasks = self.tasks.setdefault(cluster, {})
+        # Every task seen in this update is stamped with its generation, the rest are evicted at the end
+        generation = self.generations.get(cluster, 0) + 1
+        self.generations[cluster] = generation
+
+        def describe(new_task_arns):
+            for task in describe_cluster_tasks(ecs, cluster, new_task_arns):
+                task_type, family = parse_task_group(task['group'])
+                cluster_tasks[task['taskArn']] = [task_type, family, task.get('containerInstanceArn'), generation]
+                yield task_type, family, task.get('containerInstanceArn')
+
+        task_count = 0
+        described = 0
+        new_task_arns = []
+        for arn in task_arns:
+            task_count += 1
+            if arn in cluster_tasks:
+                cluster_tasks[arn][3] = generation
+                yield tuple(cluster_tasks[arn][:3])
+                continue
+            # Describe the new tasks in full batches as they turn up
+            new_task_arns.append(arn)
+            if len(new_task_arns) >= DESCRIBE_TASKS_BATCH_SIZE:
+                for task in describe(new_task_arns):
+                    yield task
+                described += len(new_task_arns)
+                new_task_arns = []
+        for task in describe(new_task_arns):
+            yield task
+        described += len(new_task_arns)
+
+        for arn in [arn for arn in cluster_tasks if cluster_tasks[arn][3] != generation]:
+            del cluster_tasks[arn]
+
+        logging.debug('Described %d of %d running tasks in cluster %s' % (described, task_count, cluster))
+
+
+def count_tasks(ecs, cluster, task_arns, task_cache=None):
+    '''
+    Count some of the running tasks in the cluster (eg. the ones on one instance) by task family
+    :param ecs: boto3 ECS client
+    :param cluster: Cluster the tasks run in
+    :param task_arns: ARNs of the running tasks to count
+    :param task_cache: TaskCache kept from earlier counts of the same tasks, if none provided, every task is described
+    :return: dict of family:{type, count}
+    '''
+    if task_cache is None:
+        task_cache = TaskCache()
+    task_families = {}
+    for task_type, family, instance in task_cache.update(ecs, cluster, task_arns):
+        add_task(task_families, family, task_type)
+    return task_families
+
+
+def take_task_snapshot(ecs, cluster, task_cache=None):
+    '''
+    Get the running tasks in the cluster, grouped both by container instance and by task family
+    :param ecs: boto3 ECS client
+    :param cluster: Cluster to query
+    :param task_cache: TaskCache kept from earlier snapshots, if none provided, every task is described
+    :return: dict with 'instances' (container instance ARN -> family -> {type, count}) and
+             'cluster' (family -> {type, count})
+    '''
+    if task_cache is None:
+        task_cache = TaskCache()
+    task_count = 0
+    snapshot = {'instances': {}, 'cluster': {}}
+    for task_type, family, instance in task_cache.update(ecs, cluster, iter_cluster_tasks(ecs, cluster)):
+        task_count += 1
+        add_task(snapshot['cluster'], family, task_type)
+        # Fargate tasks are not placed on a container instance
+        if instance:
+            add_task(snapshot['instances'].setdefault(instance, {}), family, task_type)
+
+    logging.debug('Snapshot of cluster %s: %d tasks in %d families on %d instances' %
+                  (cluster, task_count, len(snapshot['cluster']), len(snapshot['instances'])))
+    return snapshot
@@ -0,0 +1,190 @@
+"""
+Tests for agent_introspection, against a stub ECS agent and EC2 instance metadata service on a local port
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import json
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import agent_introspection
+import report_task_count_metrics
+from cycle_stats import CycleStats
+
+TASKS = [
+    {'Arn': 'arn:aws:ecs:us-east-1:123456789012:task/web-1', 'Family': 'web', 'DesiredStatus': 'RUNNING'},
+    {'Arn': 'arn:aws:ecs:us-east-1:123456789012:task/web-2', 'Family': 'web', 'DesiredStatus': 'RUNNING'},
+    {'Arn': 'arn:aws:ecs:us-east-1:123456789012:task/worker-1', 'Family': 'worker', 'DesiredStatus': 'RUNNING'},
+    {'Arn': 'arn:aws:ecs:us-east-1:123456789012:task/job-1', 'Family': 'job', 'DesiredStatus': 'STOPPED'}
+]
+
+INSTANCE_ID = 'i-0123456789abcdef0'
+TOKEN = 'stub-token'
+
+
+class StubServer(object):
+    '''
+    Serves /v1/tasks like the ECS agent and /latest like the EC2 instance metadata service
+    :param imdsv2: hand out IMDSv2 tokens, and require one for the instance ID - otherwise the token request fails
+    '''
+
+    def __init__(self, imdsv2=True):
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                server.requests.append(('GET', handler.path))
+                if handler.path == '/v1/tasks':
+                    handler.reply(200, json.dumps({'Tasks': TASKS}))
+                elif handler.path == '/latest/meta-data/instance-id':
+                    if imdsv2 and handler.headers.get('X-aws-ec2-metadata-token') != TOKEN:
+                        handler.reply(401, '')
+                    else:
+                        handler.reply(200, INSTANCE_ID)
+                else:
+                    handler.reply(404, '')
+
+            def do_PUT(handler):
+                server.requests.append(('PUT', handler.path))
+                if imdsv2 and handler.path == '/latest/api/token':
+                    handler.reply(200, TOKEN)
+                else:
+                    handler.reply(403, '')
+
+            def reply(handler, status, body):
+                handler.send_response(status)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class AgentTasksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubServer()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_count_agent_tasks_counts_running_tasks_by_family(self):
+        task_families = agent_introspection.count_agent_tasks(self.stub.url)
+        self.assertEqual(task_families, {'web': {'type': 'family', 'count': 2},
+                                         'worker': {'type': 'family', 'count': 1}})
+
+    def test_get_agent_task_arns_skips_stopped_tasks(self):
+        task_arns = agent_introspection.get_agent_task_arns(self.stub.url)
+        self.assertEqual(task_arns, [task['Arn'] for task in TASKS[:3]])
+
+
+class InstanceIdTest(unittest.TestCase):
+
+    def setUp(self):
+        agent_introspection.INSTANCE_IDS.clear()
+        self.stub = None
+
+    def tearDown(self):
+        agent_introspection.INSTANCE_IDS.clear()
+        if self.stub:
+            self.stub.stop()
+
+    def test_uses_imdsv2_token(self):
+        self.stub = StubServer(imdsv2=True)
+        self.assertEqual(agent_introspection.get_ec2_instance_id(self.stub.url + '/latest'), INSTANCE_ID)
+        self.assertEqual(self.stub.requests, [('PUT', '/latest/api/token'), ('GET', '/latest/meta-data/instance-id')])
+
+    def test_falls_back_to_imdsv1(self):
+        self.stub = StubServer(imdsv2=False)
+        self.assertEqual(agent_introspection.get_ec2_instance_id(self.stub.url + '/latest'), INSTANCE_ID)
+        self.assertEqual(self.stub.requests, [('PUT', '/latest/api/token'), ('GET', '/latest/meta-data/instance-id')])
+
+    def test_instance_id_is_only_looked_up_once(self):
+        self.stub = StubServer()
+        for i in range(3):
+            self.assertEqual(agent_introspection.get_ec2_instance_id(self.stub.url + '/latest'), INSTANCE_ID)
+        self.assertEqual(len(self.stub.requests), 2)
+
+
+class NoEcsClient(object):
+    ''' ECS client that fails on any call, recording the operations that were attempted '''
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            self.calls.append(operation)
+            raise AssertionError('Unexpected ECS call: %s' % operation)
+        return call
+
+
+class RecordingCloudWatchClient(object):
+    ''' CloudWatch client that keeps the PutMetricData requests '''
+
+    def __init__(self):
+        self.requests = []
+
+    def put_metric_data(self, **kwargs):
+        self.requests.append(kwargs)
+        return {}
+
+
+class StubClients(object):
+    ''' Stands in for a ClientCache, handing out the stub clients '''
+
+    def __init__(self):
+        self.stats = CycleStats()
+        self.ecs = NoEcsClient()
+        self.cloudwatch = RecordingCloudWatchClient()
+
+    def client(self, service, region):
+        return {'ecs': self.ecs, 'cloudwatch': self.cloudwatch}[service]
+
+
+class AgentLocalTest(unittest.TestCase):
+
+    def setUp(self):
+        agent_introspection.INSTANCE_IDS.clear()
+        self.stub = StubServer()
+        self.clients = StubClients()
+
+    def tearDown(self):
+        agent_introspection.INSTANCE_IDS.clear()
+        self.stub.stop()
+
+    def test_pushes_instance_task_counts_without_calling_ecs(self):
+        report_task_count_metrics.push_task_count_metrics(region='us-east-1', cluster='prod', clients=self.clients,
+                                                          agent_local=True, agent_url=self.stub.url,
+                                                          metadata_url=self.stub.url + '/latest')
+        self.assertEqual(self.clients.ecs.calls, [])
+        self.assertEqual(len(self.clients.cloudwatch.requests), 1)
+        request = self.clients.cloudwatch.requests[0]
+        self.assertEqual(request['Namespace'], 'ECS')
+
+        def task_count(family, count):
+            return {'MetricName': 'TaskCount', 'Unit': 'Count', 'Value': count,
+                    'Dimensions': [{'Name': 'Cluster', 'Value': 'prod'},
+                                   {'Name': 'InstanceId', 'Value': INSTANCE_ID},
+                                   {'Name': 'TaskFamily', 'Value': family}]}
+
+        metric_data = sorted(request['MetricData'], key=lambda datum: datum['Dimensions'][2]['Value'])
+        self.assertEqual(metric_data, [task_count('web', 2), task_count('worker', 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
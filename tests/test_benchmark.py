@@ -0,0 +1,52 @@
+"""
+Run the benchmark on a small simulated cluster, and check the API calls of a cold start and of the steady state
+
+The counts lock in the batching and caching of the collectors - a regression there shows up as extra calls here.
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import unittest
+from benchmark import SimulatedCluster, run_benchmark
+
+
+def batches_of(count, size):
+    ''' Number of calls it takes to send count items, size at a time '''
+    return (count + size - 1) // size
+
+
+class TaskCountBenchmarkTest(unittest.TestCase):
+
+    INSTANCES = 100
+    TASKS = 2000
+    CHURN = 0.25
+
+    @classmethod
+    def setUpClass(cls):
+        cluster = SimulatedCluster(instances=cls.INSTANCES, tasks=cls.TASKS, families=20)
+        cls.cold, cls.steady = run_benchmark(cluster, ['task-count'], cycles=2, rate=1000, churn=cls.CHURN)
+
+    def test_cold_start_describes_every_instance_and_task_once(self):
+        calls = self.cold['calls']
+        self.assertEqual(calls['ListContainerInstances'], batches_of(self.INSTANCES, 100))
+        self.assertEqual(calls['DescribeContainerInstances'], batches_of(self.INSTANCES, 100))
+        # One listing of the whole cluster gives both the instance and the cluster task counts
+        self.assertEqual(calls['ListTasks'], batches_of(self.TASKS, 100))
+        self.assertEqual(calls['DescribeTasks'], batches_of(self.TASKS, 100))
+
+    def test_steady_state_only_describes_the_new_tasks(self):
+        calls = self.steady['calls']
+        self.assertEqual(calls.get('DescribeContainerInstances', 0), 0)
+        self.assertEqual(calls['ListTasks'], batches_of(self.TASKS, 100))
+        self.assertEqual(calls['DescribeTasks'], batches_of(int(self.TASKS * self.CHURN), 100))
+
+    def test_metrics_are_sent_in_full_requests(self):
+        for result in (self.cold, self.steady):
+            self.assertGreater(result['metric_data'], 1000)
+            self.assertEqual(result['calls']['PutMetricData'], batches_of(result['metric_data'], 1000))
+            self.assertEqual(result['throttled'], {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Tests for recording a run to a capture file and replaying it, against the benchmark's simulated cluster
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import capture
+import report_task_count_metrics
+from benchmark import REGION, ApiStats, FakeClientCache, FakeCloudWatch, FakeEcs, SimulatedCluster
+from instance_resolver import InstanceResolver
+from task_snapshot import TaskCache
+
+
+class SpyClient(object):
+    ''' Passes every call on to client, keeping the PutMetricData requests '''
+
+    def __init__(self, client):
+        self.client = client
+        self.metric_data = []
+
+    def put_metric_data(self, **kwargs):
+        self.metric_data.append(kwargs)
+        return self.client.put_metric_data(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class CaptureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cluster = SimulatedCluster(instances=10, tasks=300, families=5)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def push_task_counts(self, fakes):
+        ''' Run the task count collector against the given ecs and cloudwatch clients, return the metrics it put '''
+        cloudwatch = SpyClient(fakes['cloudwatch'])
+        clients = FakeClientCache({'ecs': fakes['ecs'], 'cloudwatch': cloudwatch}, rate=1000)
+        report_task_count_metrics.push_task_count_metrics(region=REGION, cluster=self.cluster.name, clients=clients,
+                                                          instance_resolver=InstanceResolver(), task_cache=TaskCache())
+        return cloudwatch.metric_data
+
+    def record(self, path):
+        ''' Record a run against the simulated cluster, return the recorder (still open) and the metrics put '''
+        stats = ApiStats()
+        recorder = capture.Recorder(path)
+        fakes = {'ecs': recorder.client('ecs', REGION, lambda: FakeEcs(self.cluster, stats)),
+                 'cloudwatch': recorder.client('cloudwatch', REGION, lambda: FakeCloudWatch(self.cluster, stats))}
+        return recorder, self.push_task_counts(fakes)
+
+    def replay(self, path):
+        ''' Replay a run from the capture file, return the replayer and the metrics put '''
+        replayer = capture.Replayer(path)
+        fakes = {'ecs': replayer.client('ecs', REGION), 'cloudwatch': replayer.client('cloudwatch', REGION)}
+        return replayer, self.push_task_counts(fakes)
+
+    def check_round_trip(self, path):
+        recorder, recorded = self.record(path)
+        recorder.close()
+        replayer, replayed = self.replay(path)
+        self.assertTrue(recorded)
+        self.assertEqual(replayed, recorded)
+        # Every recorded call was replayed, and nothing more
+        self.assertEqual(replayer.replayed, replayer.count)
+        self.assertEqual(replayer.count, recorder.count - 1)
+
+    def test_round_trip(self):
+        self.check_round_trip(os.path.join(self.directory, 'capture.jsonl'))
+
+    def test_gzipped_round_trip(self):
+        self.check_round_trip(os.path.join(self.directory, 'capture.jsonl.gz'))
+
+    def test_gzipped_capture_of_a_run_that_died_can_be_replayed(self):
+        path = os.path.join(self.directory, 'capture.jsonl.gz')
+        died = os.path.join(self.directory, 'died.jsonl.gz')
+        recorder, recorded = self.record(path)
+        # The file as it was before close wrote the gzip trailer, as if the run had been killed
+        shutil.copy(path, died)
+        recorder.close()
+        replayer, replayed = self.replay(died)
+        self.assertEqual(replayed, recorded)
+        self.assertEqual(replayer.replayed, replayer.count)
+
+    def test_half_written_last_line_is_ignored(self):
+        path = os.path.join(self.directory, 'capture.jsonl')
+        recorder, recorded = self.record(path)
+        recorder.close()
+        with open(path, 'ab') as capture_file:
+            capture_file.write(b'{"service":"ecs","region"')
+        replayer, replayed = self.replay(path)
+        self.assertEqual(replayed, recorded)
+
+
+if __name__ == '__main__':
+    unittest.main()
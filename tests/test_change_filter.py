@@ -0,0 +1,82 @@
+"""
+Tests for the change filter, with the cycles run on a clock the tests move forward
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import unittest
+from change_filter import ChangeFilter
+
+NAMESPACE = 'ECS'
+
+
+def task_count(value, instance_id='i-0123456789abcdef0'):
+    return {
+        'MetricName': 'TaskCount',
+        'Dimensions': [{'Name': 'Cluster', 'Value': 'prod'},
+                       {'Name': 'InstanceId', 'Value': instance_id},
+                       {'Name': 'TaskFamily', 'Value': 'web'}],
+        'Value': value,
+        'Unit': 'Count'
+    }
+
+
+class ChangeFilterTest(unittest.TestCase):
+
+    def run_cycles(self, change_filter, values, interval, jitter):
+        '''
+        Run a fixed-rate cycle for each value, each checked a little (by jitter) after the cycle starts
+        :return: list of the values sent, None for the cycles that skipped theirs
+        '''
+        sent = []
+        for cycle, value in enumerate(values):
+            now = 1000.0 + cycle * interval + jitter[cycle % len(jitter)]
+            change_filter.start_cycle()
+            if change_filter.should_send(NAMESPACE, task_count(value), now=now):
+                sent.append(value)
+            else:
+                sent.append(None)
+            change_filter.finish_cycle()
+            change_filter.commit([])
+        return sent
+
+    def test_heartbeat_of_one_cycle_sends_every_jittered_cycle(self):
+        change_filter = ChangeFilter(heartbeat=300, interval=300)
+        sent = self.run_cycles(change_filter, [3] * 8, 300, [0.2, 0.6, 0.3, 0.5])
+        self.assertEqual(sent, [3] * 8)
+
+    def test_heartbeat_of_several_cycles_is_sent_on_time_despite_jitter(self):
+        change_filter = ChangeFilter(heartbeat=300, interval=60)
+        sent = self.run_cycles(change_filter, [3] * 11, 60, [0.6, 0.2, 0.5, 0.3])
+        self.assertEqual(sent, [3, None, None, None, None, 3, None, None, None, None, 3])
+
+    def test_changed_value_is_sent_straight_away(self):
+        change_filter = ChangeFilter(heartbeat=300, interval=60)
+        sent = self.run_cycles(change_filter, [3, 3, 4, 4, 3], 60, [0.4])
+        self.assertEqual(sent, [3, None, 4, None, 3])
+
+    def test_failed_send_is_retried_next_cycle(self):
+        change_filter = ChangeFilter(heartbeat=300, interval=60)
+        change_filter.start_cycle()
+        self.assertTrue(change_filter.should_send(NAMESPACE, task_count(3), now=1000.0))
+        change_filter.finish_cycle()
+        change_filter.commit([(NAMESPACE, task_count(3), 'Throttling')])
+        change_filter.start_cycle()
+        self.assertTrue(change_filter.should_send(NAMESPACE, task_count(3), now=1060.0))
+
+    def test_series_that_went_away_is_zeroed_once(self):
+        change_filter = ChangeFilter(heartbeat=300, interval=60)
+        change_filter.start_cycle()
+        change_filter.should_send(NAMESPACE, task_count(3), now=1000.0)
+        change_filter.finish_cycle()
+        change_filter.commit([])
+        change_filter.start_cycle()
+        self.assertEqual(change_filter.finish_cycle(), [(NAMESPACE, task_count(0))])
+        change_filter.commit([])
+        change_filter.start_cycle()
+        self.assertEqual(change_filter.finish_cycle(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+"""
+Tests for the collector daemon's scheduling - of targets, with stub targets that sleep instead of collecting, and of
+cycles and publishes, on a clock the tests move forward
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import threading
+import time
+import unittest
+import collector_daemon
+from aws_clients import ClientCache
+from collector_daemon import CollectorDaemon
+
+
+class SleepingTarget(object):
+    '''
+    Stands in for a Target, taking delay seconds to collect
+    '''
+
+    def __init__(self, name, delay):
+        self.name = name
+        self.delay = delay
+        self.collections = 0
+        self.running = threading.Event()
+        self.started = None
+
+    def collect(self, clients, publish=True):
+        self.started = time.time()
+        try:
+            time.sleep(self.delay)
+            self.collections += 1
+        finally:
+            self.running.clear()
+
+
+class CollectTargetsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.daemon = None
+
+    def tearDown(self):
+        # Let any target left running in the background finish
+        if self.daemon and self.daemon.pool:
+            self.daemon.pool.close()
+            self.daemon.pool.join()
+
+    def build_daemon(self, targets, workers, timeout):
+        self.daemon = CollectorDaemon(targets, 300, ClientCache(), workers=workers, timeout=timeout)
+        return self.daemon
+
+    def timed_collect(self, deadline=None):
+        started = time.time()
+        self.daemon.collect_targets(True, deadline)
+        return time.time() - started
+
+    def test_queued_target_is_not_timed_out_before_it_starts(self):
+        first, queued = SleepingTarget('first', 0.2), SleepingTarget('queued', 0.2)
+        self.build_daemon([first, queued], workers=1, timeout=0.3)
+        # queued waits 0.2 seconds for the only worker - timed from when it was queued, it would be given up on at 0.3
+        self.timed_collect()
+        self.assertEqual(first.collections, 1)
+        self.assertEqual(queued.collections, 1)
+
+    def test_slow_target_does_not_hold_up_the_next_cycle(self):
+        slow, fast = SleepingTarget('slow', 1.0), SleepingTarget('fast', 0.05)
+        self.build_daemon([slow, fast], workers=2, timeout=10)
+        elapsed = self.timed_collect(deadline=time.time() + 0.3)
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(fast.collections, 1)
+        self.assertTrue(slow.running.is_set())
+
+    def test_still_running_target_is_skipped_on_the_next_cycle(self):
+        slow, fast = SleepingTarget('slow', 0.6), SleepingTarget('fast', 0.05)
+        self.build_daemon([slow, fast], workers=2, timeout=10)
+        self.timed_collect(deadline=time.time() + 0.2)
+        self.timed_collect(deadline=time.time() + 0.2)
+        self.assertEqual(fast.collections, 2)
+        self.daemon.pool.close()
+        self.daemon.pool.join()
+        # Not queued up behind itself by the second cycle
+        self.assertEqual(slow.collections, 1)
+
+    def test_gives_up_when_every_worker_is_held_by_a_timed_out_target(self):
+        slow, queued = SleepingTarget('slow', 1.0), SleepingTarget('queued', 0.05)
+        self.build_daemon([slow, queued], workers=1, timeout=0.1)
+        elapsed = self.timed_collect()
+        self.assertLess(elapsed, 0.5)
+        self.assertIsNone(queued.started)
+
+
+class RunScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.real_time = collector_daemon.time.time
+        self.real_sleep = collector_daemon.time.sleep
+        collector_daemon.time.time = lambda: self.now
+        collector_daemon.time.sleep = self.sleep
+
+    def tearDown(self):
+        collector_daemon.time.time = self.real_time
+        collector_daemon.time.sleep = self.real_sleep
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def run_schedule(self, frequency, sample_interval, cycles, durations=None):
+        '''
+        Run the daemon for cycles, each cycle taking the seconds given for its start time in durations (or none)
+        :return: list of (start time, publish) for each cycle
+        '''
+        durations = durations or {}
+        daemon = CollectorDaemon([SleepingTarget('target', 0)], frequency, ClientCache(),
+                                 sample_interval=sample_interval)
+        ran = []
+
+        def run_cycle(publish, deadline=None):
+            ran.append((self.now, publish))
+            self.now += durations.get(self.now, 0)
+        daemon.run_cycle = run_cycle
+        daemon.run(cycles)
+        return ran
+
+    def publish_times(self, ran):
+        return [started for started, publish in ran if publish]
+
+    def test_publishes_every_cycle_without_a_sample_interval(self):
+        ran = self.run_schedule(60, None, 3)
+        self.assertEqual(ran, [(0, True), (60, True), (120, True)])
+
+    def test_publishes_once_per_frequency_when_the_sample_interval_does_not_divide_it(self):
+        ran = self.run_schedule(60, 25, 10)
+        self.assertEqual([started for started, publish in ran], [0, 25, 50, 75, 100, 125, 150, 175, 200, 225])
+        # The last sample before each 60 second boundary publishes
+        self.assertEqual(self.publish_times(ran), [50, 100, 175, 225])
+
+    def test_publishes_each_window_after_an_overrun(self):
+        # The sample at 20 takes until 70, so the samples at 40 and 60 are skipped
+        ran = self.run_schedule(60, 20, 8, {20: 50})
+        self.assertEqual([started for started, publish in ran], [0, 20, 80, 100, 120, 140, 160, 180])
+        # The window up to 60 is published late (at 80) rather than lost, and the next one still on time
+        self.assertEqual(self.publish_times(ran), [80, 100, 160])
+
+    def test_skips_windows_without_a_sample(self):
+        # The first sample takes until 130, so no sample falls between 60 and 120 - that window is skipped rather
+        # than published empty, and the next publish is back on time
+        ran = self.run_schedule(60, 20, 6, {0: 130})
+        self.assertEqual([started for started, publish in ran], [0, 140, 160, 180, 200, 220])
+        self.assertEqual(self.publish_times(ran), [140, 160, 220])
+
+
+if __name__ == '__main__':
+    unittest.main()
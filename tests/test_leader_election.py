@@ -0,0 +1,168 @@
+"""
+Tests for the leader election backends - the file backend with the nodes sharing a lease file in a temporary
+directory, the ECS backend with the nodes sharing a fake ECS client
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import leader_election
+from leader_election import HEARTBEAT_ATTRIBUTE, EcsLeaderElection, FileLeaderElection
+
+
+class FileLeaderElectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock_file = os.path.join(self.directory, 'leader.lock')
+        self.now = 1000.0
+        self.real_time = leader_election.time.time
+        # Leases expire on a clock the tests move forward, rather than by sleeping
+        leader_election.time.time = lambda: self.now
+
+    def tearDown(self):
+        leader_election.time.time = self.real_time
+        shutil.rmtree(self.directory)
+
+    def node(self, node_id, lease=60):
+        return FileLeaderElection(self.lock_file, node_id, lease=lease, check_interval=0)
+
+    def lease_holder(self):
+        with open(self.lock_file) as lock_file:
+            return json.load(lock_file)
+
+    def test_first_node_takes_the_lease(self):
+        first, second = self.node('node-a'), self.node('node-b')
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+        self.assertEqual(self.lease_holder(), {'node': 'node-a', 'expires': 1060.0})
+
+    def test_leader_renews_its_lease(self):
+        first, second = self.node('node-a'), self.node('node-b')
+        self.assertTrue(first.is_leader())
+        # Renewed before it expires, so the lease never lapses
+        for i in range(3):
+            self.now += 50
+            self.assertTrue(first.is_leader())
+            self.assertFalse(second.is_leader())
+        self.assertEqual(self.lease_holder()['expires'], self.now + 60)
+
+    def test_another_node_takes_over_once_the_lease_expires(self):
+        first, second = self.node('node-a'), self.node('node-b')
+        self.assertTrue(first.is_leader())
+        # node-a stops renewing (eg. its instance went away)
+        self.now += 59
+        self.assertFalse(second.is_leader())
+        self.now += 1
+        self.assertTrue(second.is_leader())
+        self.assertFalse(first.is_leader())
+        self.assertEqual(self.lease_holder()['node'], 'node-b')
+
+    def test_is_leader_only_rechecks_after_the_check_interval(self):
+        first = FileLeaderElection(self.lock_file, 'node-a', lease=60, check_interval=90)
+        second = self.node('node-b')
+        self.assertTrue(first.is_leader())
+        self.now += 60
+        self.assertTrue(second.is_leader())
+        # node-a still trusts its last check until the check interval is up
+        self.assertTrue(first.is_leader())
+        self.now += 30
+        self.assertFalse(first.is_leader())
+
+    def test_unreadable_lease_file_is_taken_over(self):
+        with open(self.lock_file, 'w') as lock_file:
+            lock_file.write('not json')
+        self.assertTrue(self.node('node-a').is_leader())
+        self.assertEqual(self.lease_holder()['node'], 'node-a')
+
+
+class FakeEcs(object):
+    '''
+    Container instances of one cluster, with their agent connection and attributes
+    :param arns: ARNs of the active container instances
+    '''
+
+    def __init__(self, arns):
+        self.connected = dict((arn, True) for arn in arns)
+        self.attributes = dict((arn, {}) for arn in arns)
+
+    def list_container_instances(self, cluster, status=None, nextToken=None):
+        return {'containerInstanceArns': list(self.connected)}
+
+    def describe_container_instances(self, cluster, containerInstances):
+        return {'containerInstances': [
+            {'containerInstanceArn': arn, 'agentConnected': self.connected[arn],
+             'attributes': [{'name': name, 'value': value} for name, value in self.attributes[arn].items()]}
+            for arn in containerInstances], 'failures': []}
+
+    def put_attributes(self, cluster, attributes):
+        for attribute in attributes:
+            self.attributes[attribute['targetId']][attribute['name']] = attribute['value']
+        return {'attributes': attributes}
+
+
+class EcsLeaderElectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ecs = FakeEcs(['arn-c', 'arn-a', 'arn-b'])
+        self.now = 1000.0
+        self.real_time = leader_election.time.time
+        # Heartbeats expire on a clock the tests move forward, rather than by sleeping
+        leader_election.time.time = lambda: self.now
+
+    def tearDown(self):
+        leader_election.time.time = self.real_time
+
+    def node(self, node_id):
+        return EcsLeaderElection(self.ecs, 'prod', node_id, lease=60, check_interval=0)
+
+    def heartbeat(self, node_id):
+        return self.ecs.attributes[node_id].get(HEARTBEAT_ATTRIBUTE)
+
+    def test_lowest_arn_leads_and_renews_its_heartbeat(self):
+        first, second = self.node('arn-a'), self.node('arn-b')
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+        self.assertEqual(self.heartbeat('arn-a'), '1000')
+        self.now += 50
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+        self.assertEqual(self.heartbeat('arn-a'), '1050')
+        # Only the leader writes a heartbeat
+        self.assertIsNone(self.heartbeat('arn-b'))
+
+    def test_next_arn_takes_over_once_the_heartbeat_expires(self):
+        first, second = self.node('arn-a'), self.node('arn-b')
+        self.assertTrue(first.is_leader())
+        # The collector on arn-a stops, but its instance stays active
+        self.now += 59
+        self.assertFalse(second.is_leader())
+        self.now += 1
+        self.assertTrue(second.is_leader())
+        self.assertFalse(self.node('arn-c').is_leader())
+
+    def test_instance_with_a_disconnected_agent_is_skipped(self):
+        first, second = self.node('arn-a'), self.node('arn-b')
+        self.assertTrue(first.is_leader())
+        self.ecs.connected['arn-a'] = False
+        self.assertTrue(second.is_leader())
+
+    def test_lowest_arn_takes_back_the_lead_when_it_returns(self):
+        first, second = self.node('arn-a'), self.node('arn-b')
+        self.assertTrue(first.is_leader())
+        self.now += 60
+        self.assertTrue(second.is_leader())
+        self.assertTrue(first.is_leader())
+        self.assertFalse(second.is_leader())
+
+    def test_node_outside_the_cluster_does_not_lead(self):
+        self.assertFalse(self.node('arn-0').is_leader())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests for the aggregation of sampled metrics into StatisticValues entries
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import unittest
+from metric_publisher import MetricAggregator
+
+CLUSTER_SCOPE = 'cluster'
+INSTANCE_SCOPE = 'instance'
+
+
+class RecordingPublisher(object):
+    ''' Stands in for a MetricPublisher, keeping what was put in it by task family and instance ID '''
+
+    def __init__(self):
+        self.data = {}
+
+    def put(self, namespace, datum):
+        dimensions = dict((dimension['Name'], dimension['Value']) for dimension in datum['Dimensions'])
+        self.data[(dimensions['TaskFamily'], dimensions.get('InstanceId'))] = datum
+
+
+def task_count(family, count, instance_id=None):
+    dimensions = [{'Name': 'Cluster', 'Value': 'prod'}]
+    if instance_id:
+        dimensions.append({'Name': 'InstanceId', 'Value': instance_id})
+    dimensions.append({'Name': 'TaskFamily', 'Value': family})
+    return {'MetricName': 'TaskCount', 'Dimensions': dimensions, 'Value': count, 'Unit': 'Count'}
+
+
+def statistics(sample_count, total, minimum, maximum):
+    return {'SampleCount': sample_count, 'Sum': total, 'Minimum': minimum, 'Maximum': maximum}
+
+
+class MetricAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.aggregator = MetricAggregator()
+
+    def sample(self, *data, **kwargs):
+        ''' Take one round of samples, adding each datum with the given scope '''
+        scope = kwargs.get('scope')
+        self.aggregator.start_sample()
+        for datum in data:
+            self.aggregator.add('ECS', datum, scope)
+        for covered in kwargs.get('covers', []):
+            self.aggregator.cover(covered)
+        self.aggregator.finish_sample()
+
+    def flush(self):
+        publisher = RecordingPublisher()
+        self.aggregator.flush(publisher)
+        return dict((key, datum['StatisticValues']) for key, datum in publisher.data.items())
+
+    def test_samples_are_sent_as_statistic_values(self):
+        self.sample(task_count('web', 2))
+        self.sample(task_count('web', 5))
+        self.sample(task_count('web', 3))
+        self.assertEqual(self.flush(), {('web', None): statistics(3, 10, 2, 5)})
+        # Then starts over
+        self.assertEqual(self.flush(), {})
+
+    def test_failed_sample_is_dropped(self):
+        self.sample(task_count('web', 2))
+        # The sampler failed part way through this round
+        self.aggregator.start_sample()
+        self.aggregator.add('ECS', task_count('web', 0))
+        self.aggregator.discard_sample()
+        self.sample(task_count('web', 4))
+        self.assertEqual(self.flush(), {('web', None): statistics(2, 6, 2, 4)})
+
+    def test_series_missing_from_some_rounds_is_zero_filled(self):
+        self.sample(task_count('web', 2), task_count('worker', 3))
+        self.sample(task_count('web', 2))
+        self.sample(task_count('web', 2), task_count('worker', 1))
+        self.assertEqual(self.flush(), {('web', None): statistics(3, 6, 2, 2),
+                                        ('worker', None): statistics(3, 4, 0, 3)})
+
+    def test_scoped_series_only_count_the_rounds_that_covered_their_scope(self):
+        # Leader for the first two rounds, then another node takes over
+        self.sample(task_count('web', 4), scope=CLUSTER_SCOPE)
+        self.sample(covers=[CLUSTER_SCOPE])
+        self.sample()
+        self.sample()
+        self.assertEqual(self.flush(), {('web', None): statistics(2, 4, 0, 4)})
+
+    def test_instance_and_cluster_scopes_are_counted_independently(self):
+        # Not the leader in the first round, so only the instance task counts were sampled
+        self.sample(task_count('web', 1, 'i-1'), scope=INSTANCE_SCOPE)
+        self.aggregator.start_sample()
+        self.aggregator.add('ECS', task_count('web', 1, 'i-1'), INSTANCE_SCOPE)
+        self.aggregator.add('ECS', task_count('web', 6), CLUSTER_SCOPE)
+        self.aggregator.finish_sample()
+        self.assertEqual(self.flush(), {('web', 'i-1'): statistics(2, 2, 1, 1),
+                                        ('web', None): statistics(1, 6, 6, 6)})
+
+    def test_storage_resolution_is_set_on_every_entry(self):
+        self.aggregator = MetricAggregator(storage_resolution=1)
+        self.sample(task_count('web', 2))
+        publisher = RecordingPublisher()
+        self.aggregator.flush(publisher)
+        self.assertEqual(publisher.data[('web', None)]['StorageResolution'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+"""
+Tests for the rate limiter and retries, against a fake client with the backoff sleeps patched out
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import unittest
+from botocore.exceptions import ClientError, EndpointConnectionError
+import rate_limiter
+from rate_limiter import SUCCESS_WINDOW, AdaptiveRateLimiter, RateLimitedClient, RetryBudget
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, 'ListTasks')
+
+
+class FakeClient(object):
+    '''
+    Client whose list_tasks raises each of outcomes in turn (or returns it, if it is not an exception), then succeeds
+    '''
+
+    def __init__(self, outcomes=None):
+        self.outcomes = list(outcomes or [])
+        self.calls = 0
+
+    def list_tasks(self, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0) if self.outcomes else {'taskArns': []}
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class RateLimitedClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sleeps = []
+        self.real_sleep = rate_limiter.time.sleep
+        self.real_backoff_time = rate_limiter.backoff_time
+        rate_limiter.time.sleep = self.sleeps.append
+        rate_limiter.backoff_time = lambda attempt: attempt + 1
+        # Fast enough that acquire never has to wait
+        self.limiter = AdaptiveRateLimiter(1000)
+
+    def tearDown(self):
+        rate_limiter.time.sleep = self.real_sleep
+        rate_limiter.backoff_time = self.real_backoff_time
+
+    def wrap(self, client, retries=5):
+        return RateLimitedClient(client, self.limiter, RetryBudget(retries))
+
+    def test_retries_then_succeeds(self):
+        client = FakeClient([client_error('Throttling'), client_error('ServiceUnavailable'),
+                             EndpointConnectionError(endpoint_url='https://ecs.us-east-1.amazonaws.com')])
+        self.assertEqual(self.wrap(client).list_tasks(cluster='prod'), {'taskArns': []})
+        self.assertEqual(client.calls, 4)
+        self.assertEqual(self.sleeps, [1, 2, 3])
+
+    def test_raises_once_the_retry_budget_is_used_up(self):
+        client = FakeClient([client_error('Throttling')] * 10)
+        with self.assertRaises(ClientError):
+            self.wrap(client, retries=3).list_tasks(cluster='prod')
+        # The first call and 3 retries
+        self.assertEqual(client.calls, 4)
+
+    def test_budget_is_shared_by_every_call(self):
+        budget = RetryBudget(2)
+        client = FakeClient([client_error('Throttling')] * 2 + [{'taskArns': ['a']}, client_error('Throttling')])
+        wrapped = RateLimitedClient(client, self.limiter, budget)
+        self.assertEqual(wrapped.list_tasks(cluster='prod'), {'taskArns': ['a']})
+        with self.assertRaises(ClientError):
+            wrapped.list_tasks(cluster='prod')
+        budget.reset()
+        self.assertEqual(wrapped.list_tasks(cluster='prod'), {'taskArns': []})
+
+    def test_non_retryable_error_is_raised_at_once(self):
+        client = FakeClient([client_error('AccessDeniedException')])
+        with self.assertRaises(ClientError) as raised:
+            self.wrap(client).list_tasks(cluster='prod')
+        self.assertEqual(raised.exception.response['Error']['Code'], 'AccessDeniedException')
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(self.sleeps, [])
+
+    def test_throttling_halves_the_rate(self):
+        client = FakeClient([client_error('Throttling'), client_error('Throttling')])
+        self.wrap(client).list_tasks(cluster='prod')
+        self.assertEqual(self.limiter.rate, 250.0)
+
+    def test_transient_error_leaves_the_rate_alone(self):
+        client = FakeClient([client_error('InternalError')])
+        self.wrap(client).list_tasks(cluster='prod')
+        self.assertEqual(self.limiter.rate, 1000.0)
+
+
+class AdaptiveRateLimiterTest(unittest.TestCase):
+
+    def test_rate_grows_after_a_window_of_successes(self):
+        limiter = AdaptiveRateLimiter(10)
+        for i in range(SUCCESS_WINDOW - 1):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 10.0)
+        limiter.on_success()
+        self.assertEqual(limiter.rate, 11.0)
+
+    def test_throttling_starts_the_window_over(self):
+        limiter = AdaptiveRateLimiter(10)
+        for i in range(SUCCESS_WINDOW - 1):
+            limiter.on_success()
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 5.0)
+        for i in range(SUCCESS_WINDOW - 1):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 5.0)
+        limiter.on_success()
+        self.assertEqual(limiter.rate, 6.0)
+
+    def test_rate_stays_within_its_bounds(self):
+        limiter = AdaptiveRateLimiter(2, max_rate=3)
+        for i in range(SUCCESS_WINDOW * 5):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 3.0)
+        for i in range(10):
+            limiter.on_throttle()
+        self.assertEqual(limiter.rate, rate_limiter.MIN_RATE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Tests for the stack parameter cache, against a fake CloudFormation client on a clock the tests move forward
+
+Run from the top of the repository with: python -m unittest discover tests
+
+"""
+
+import unittest
+from botocore.exceptions import ClientError
+import threshold_provider
+from threshold_provider import ThresholdProvider
+
+PARAMETERS = [{'ParameterKey': 'ScaleDownCPU', 'ParameterValue': '40'},
+              {'ParameterKey': 'ScaleDownMemory', 'ParameterValue': '50'},
+              {'ParameterKey': 'ClusterMinSize', 'ParameterValue': '2'}]
+
+
+class FakeCloudFormation(object):
+    ''' Describes one stack, or fails with error if it is set '''
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    def describe_stacks(self, StackName):
+        self.calls += 1
+        if self.error:
+            raise self.error
+        return {'Stacks': [{'StackName': StackName, 'Parameters': PARAMETERS, 'CreationTime': '2026-01-01'}]}
+
+
+class ThresholdProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cloudformation = FakeCloudFormation()
+        self.now = 1000.0
+        self.real_time = threshold_provider.time.time
+        threshold_provider.time.time = lambda: self.now
+
+    def tearDown(self):
+        threshold_provider.time.time = self.real_time
+
+    def test_parameters_are_cached_for_the_ttl(self):
+        provider = ThresholdProvider(ttl=900)
+        self.assertEqual(provider.get_parameters(self.cloudformation, 'prod'), PARAMETERS)
+        self.now += 899
+        self.assertEqual(provider.get_parameters(self.cloudformation, 'prod'), PARAMETERS)
+        self.assertEqual(self.cloudformation.calls, 1)
+        self.now += 1
+        provider.get_parameters(self.cloudformation, 'prod')
+        self.assertEqual(self.cloudformation.calls, 2)
+
+    def test_expired_parameters_are_used_when_the_stack_cannot_be_described(self):
+        provider = ThresholdProvider(ttl=900)
+        provider.get_parameters(self.cloudformation, 'prod')
+        self.cloudformation.error = ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}},
+                                                'DescribeStacks')
+        self.now += 900
+        self.assertEqual(provider.get_parameters(self.cloudformation, 'prod'), PARAMETERS)
+        # Described again on the next call, until it works
+        self.now += 60
+        self.assertEqual(provider.get_parameters(self.cloudformation, 'prod'), PARAMETERS)
+        self.assertEqual(self.cloudformation.calls, 3)
+        self.cloudformation.error = None
+        provider.get_parameters(self.cloudformation, 'prod')
+        self.now += 60
+        provider.get_parameters(self.cloudformation, 'prod')
+        self.assertEqual(self.cloudformation.calls, 4)
+
+    def test_failure_without_cached_parameters_is_raised(self):
+        self.cloudformation.error = ClientError({'Error': {'Code': 'ValidationError', 'Message': 'No such stack'}},
+                                                'DescribeStacks')
+        with self.assertRaises(ClientError):
+            ThresholdProvider().get_parameters(self.cloudformation, 'prod')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Cache the scale down thresholds read from a CloudFormation stack
+
+The ScaleDownCPU, ScaleDownMemory and ClusterMinSize stack parameters almost never change, so the stack's
+parameters are cached (in memory, and optionally on local disk) and describe_stacks is only called again once
+the cache entry is older than its TTL. Each entry records the stack's LastUpdatedTime, so a refresh logs when the stack
+has actually changed since the parameters were cached. If the stack cannot be described once the entry has expired
+(eg. CloudFormation is throttling or unreachable), the cached parameters are used until it can, rather than failing
+the cycle.
+
+Requires: boto3  - https://boto3.readthedocs.io/en/latest/index.html
+
+"""
+
+import logging
+import time
+from json_cache import load_json_cache, save_json_cache
+
+# Seconds before the cached parameters of a stack are checked again
+DEFAULT_STACK_TTL = 15 * 60
+
+
+class ThresholdProvider(object):
+    '''
+    TTL cache of stack name -> stack parameters
+    :param ttl: seconds before a stack is described again
+    :param cache_file: optional path of a JSON file used to keep the cache between runs
+    '''
+
+    def __init__(self, ttl=DEFAULT_STACK_TTL, cache_file=None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.cache = {}
+        if cache_file:
+            self.cache = load_json_cache(cache_file, 'stack')
+
+    def get_parameters(self, cloudformation, stack_name):
+        '''
+        Get the parameters of the stack, from the cache if they were fetched less than ttl seconds ago, or if the
+        stack cannot be described
+        :param cloudformation: boto3 CloudFormation client
+        :return: list of {ParameterKey, ParameterValue}, as returned by describe_stacks
+        '''
+        now = time.time()
+        entry = self.cache.get(stack_name)
+        if entry and now - entry['fetched_at'] < self.ttl:
+            logging.debug('Using cached parameters for stack %s' % stack_name)
+            return entry['parameters']
+
+        try:
+            ds_result = cloudformation.describe_stacks(StackName=stack_name)
+        except Exception as e:
+            if not entry:
+                raise
+            logging.warn('Unable to describe stack %s, using its parameters from %d seconds ago: %s' %
+                         (stack_name, now - entry['fetched_at'], e))
+            return entry['parameters']
+        parameters = []
+        last_updated = None
+        if 'Stacks' in ds_result:
+            stack = ds_result['Stacks'][0]
+            parameters = stack.get('Parameters', [])
+            # Stacks that were never updated only have a CreationTime
+            last_updated = str(stack.get('LastUpdatedTime', stack.get('CreationTime')))
+
+        if entry and entry['last_updated'] != last_updated:
+            logging.info('Stack %s was updated at %s - refreshing its parameters' % (stack_name, last_updated))
+        self.cache[stack_name] = {'parameters': parameters, 'last_updated': last_updated, 'fetched_at': now}
+        if self.cache_file:
+            save_json_cache(self.cache_file, self.cache, 'stack')
+        return parameters